@@ -0,0 +1,13 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  基准测试, 见suite
+  配置在首次导入blogs.app时加载, 这里先设置默认的sqlite内存库, 不需要MySQL; 已设置的环境变量优先
+"""
+import os
+
+__author__ = 'boris han'
+
+os.environ.setdefault('AWESOME_DB__BACKEND', 'sqlite')
+os.environ.setdefault('AWESOME_DB__CREATE_TABLES', 'true')
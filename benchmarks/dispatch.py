@@ -0,0 +1,147 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  RequestHandler参数绑定耗时对比: 旧版逐请求判断 vs 注册时预编译的绑定函数
+    python -m benchmarks.dispatch [--requests 2000]
+  结果以JSON输出, 单位微秒/请求
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from urllib import parse
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+from blogs.CoroutineWeb import RequestHandler, get, post
+
+__author__ = 'boris han'
+
+
+class LegacyRequestHandler(RequestHandler):
+    """
+      预编译之前的__call__, 仅用于对比
+    """
+
+    async def __call__(self, request):
+        kw = None
+        if self._has_var_kwarg or self._has_named_kwarg or self._required_kwarg:
+            if request.method == 'POST':
+                content_type = request.content_type.lower()
+                if content_type.startswith('application/json'):
+                    kw = await request.json()
+                else:
+                    kw = await request.post()
+            if request.method == 'GET':
+                query_params = request.query_string
+                if query_params:
+                    kw = dict()
+                    for key, value in parse.parse_qs(query_params, True).items():
+                        kw[key] = value[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not self._has_var_kwarg and self._named_kwarg:
+                copy = dict()
+                for name in self._named_kwarg:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                if k in kw:
+                    logging.warning('Duplicate arg name in named arg and kw args:%s' % k)
+                kw[k] = v
+        if self._has_request_arg:
+            kw['request'] = request
+        if self._required_kwarg:
+            for name in self._required_kwarg:
+                if name not in kw:
+                    return web.HTTPBadRequest()
+        logging.info('call with args: %s ' % str(kw))
+        return await self._func(**kw)
+
+
+@get('/')
+async def index(request):
+    return web.Response(text='ok')
+
+
+@get('/blog/{id}')
+async def blog(id):
+    return web.Response(text=id)
+
+
+@get('/api/blogs')
+async def api_blogs(*, page='1'):
+    return web.Response(text=page)
+
+
+@post('/api/blogs')
+async def api_create_blog(*, name, summary, content):
+    return web.Response(text=name)
+
+
+ROUTES = [
+    (index, 'GET', '/', None),
+    (blog, 'GET', '/blog/001', None),
+    (api_blogs, 'GET', '/api/blogs?page=2', None),
+    (api_create_blog, 'POST', '/api/blogs', dict(name='n', summary='s', content='c')),
+]
+
+
+async def bench_direct(handler_class, fn, method, url, iterations):
+    """
+    直接调用handler, 只包含参数绑定和函数调用
+    """
+    handler = handler_class(None, fn)
+    match_info = {'id': url.rsplit('/', 1)[-1]} if '{' in fn.__route__ else {}
+    request = make_mocked_request(method, url, match_info=match_info)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await handler(request)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+async def bench_client(handler_class, fn, method, url, body, iterations):
+    """
+    通过进程内aiohttp test client发起完整请求
+    """
+    app = web.Application()
+    app.router.add_route(fn.__method__, fn.__route__, handler_class(app, fn))
+    async with TestClient(TestServer(app)) as client:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            resp = await client.request(method, url, json=body)
+            await resp.read()
+        return (time.perf_counter() - start) / iterations * 1e6
+
+
+async def run(iterations):
+    results = dict()
+    for fn, method, url, body in ROUTES:
+        result = dict()
+        for name, handler_class in (('legacy', LegacyRequestHandler), ('compiled', RequestHandler)):
+            if body is None:
+                result['%s_direct_us' % name] = await bench_direct(handler_class, fn, method, url, iterations * 10)
+            result['%s_client_us' % name] = await bench_client(handler_class, fn, method, url, body, iterations)
+        if body is None:
+            result['direct_speedup'] = result['legacy_direct_us'] / result['compiled_direct_us']
+        results['%s %s' % (method, fn.__route__)] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RequestHandler dispatch benchmark')
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+    # 关闭INFO日志: 旧版仍会提前格式化参数, 与线上开销一致
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.get_event_loop().run_until_complete(run(args.requests))
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
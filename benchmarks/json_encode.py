@@ -0,0 +1,56 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  JSON实现对比: 编码10000个Blog对象
+    python -m benchmarks.json_encode [--rows 10000] [--repeat 20]
+  结果以JSON输出, 单位毫秒/次
+"""
+import argparse
+import json
+import time
+
+from blogs import codec
+from blogs.entity import Blog
+
+__author__ = 'boris han'
+
+
+def make_blogs(rows):
+    now = time.time()
+    return [Blog(id='%050d' % i, customer_id='%050d' % (i % 100), customer_name=u'用户%s' % (i % 100),
+                 customer_image='http://www.gravatar.com/avatar/%s' % i, name=u'博客%s' % i,
+                 summary=u'摘要' * 20, content=u'内容' * 200, created_at=now - i) for i in range(rows)]
+
+
+def bench(dumps, obj, repeat):
+    dumps(obj)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        dumps(obj)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON backend benchmark')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    blogs = dict(blogs=make_blogs(args.rows))
+    results = dict()
+    # 旧版response_factory的编码方式
+    results['legacy_json_ms'] = bench(
+        lambda obj: json.dumps(obj, ensure_ascii=False, default=lambda msg: msg.__dict__).encode('utf-8'),
+        blogs, args.repeat)
+    for name, dumps, loads in codec.available_backends():
+        results['%s_ms' % name] = bench(dumps, blogs, args.repeat)
+    results['selected'] = codec.backend
+    results['bytes'] = len(codec.dumps(blogs))
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
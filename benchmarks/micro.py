@@ -0,0 +1,139 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  微基准: ModelMetaClass生成SQL, 由行构造Model, RequestHandler参数绑定, response_factory编码
+    python -m benchmarks.micro [--number 1000]
+  结果以JSON输出, 单位微秒/次, 取多轮中最快的一轮
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from blogs.app import datetime_filter, init_jinja2, response_factory
+from blogs.CoroutineWeb import RequestHandler, get
+from blogs.entity import Blog, Customer
+from blogs.Orm import FloatField, Model, ModelMetaClass, StringField, TextField
+
+__author__ = 'boris han'
+
+REPEAT = 5
+
+
+def measure(fn, number):
+    """
+    :return: 每次调用的微秒数
+    """
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / number * 1e6
+
+
+async def measure_async(fn, number):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for _ in range(number):
+            await fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / number * 1e6
+
+
+def define_model():
+    attrs = dict(__table__='bench', id=StringField(is_primary=True, ddl='varchar(50)'),
+                 name=StringField(ddl='varchar(50)'), summary=StringField(ddl='varchar(200)'),
+                 content=TextField(), created_at=FloatField())
+    return ModelMetaClass('BenchModel', (Model,), attrs)
+
+
+def make_rows(rows):
+    now = time.time()
+    return [('%050d' % i, '%050d' % (i % 100), 'user%s' % (i % 100), 'http://www.gravatar.com/avatar/%s' % i,
+             'blog%s' % i, 'summary', 'content', now - i) for i in range(rows)]
+
+
+def bench_models(number):
+    result = dict(metaclass_us=measure(define_model, number))
+    # 生成的类不再引用, 回收后不会出现在Model.__subclasses__()中
+    gc.collect()
+    rows = make_rows(1000)
+    plan = Blog.compile_select()
+    result['model_decode_us_per_row'] = measure(lambda: plan.decode(rows), max(1, number // 100)) / len(rows)
+    result['row_decode_us_per_row'] = measure(lambda: plan.decode_rows(rows), max(1, number // 100)) / len(rows)
+    return result
+
+
+@get('/blog/{id}')
+async def blog(id):
+    return id
+
+
+@get('/api/blogs')
+async def api_blogs(*, page='1', page_size='20'):
+    return page
+
+
+@get('/manage/blogs')
+async def manage_blogs(request, *, page='1'):
+    return page
+
+
+async def bench_binding(number):
+    result = dict()
+    for name, fn, url, match_info in (('match_info', blog, '/blog/001', {'id': '001'}),
+                                      ('query', api_blogs, '/api/blogs?page=2&page_size=10', {}),
+                                      ('request_query', manage_blogs, '/manage/blogs?page=3', {})):
+        handler = RequestHandler(None, fn)
+        request = make_mocked_request('GET', url, match_info=match_info)
+        result['%s_bind_us' % name] = measure(lambda: handler._bind(request), number)
+        result['%s_call_us' % name] = await measure_async(lambda: handler(request), number)
+    return result
+
+
+async def bench_encoding(number):
+    app = web.Application()
+    init_jinja2(app, filters=dict(datetime=datetime_filter), auto_reload=False)
+    now = time.time()
+    blogs = [Blog(id='%050d' % i, name='blog%s' % i, summary='summary' * 10, created_at=now - i) for i in range(20)]
+    users = [Customer(id='%050d' % i, name='user%s' % i, email='user%s@example.com' % i) for i in range(20)]
+    request = make_mocked_request('GET', '/')
+    result = dict()
+    for name, data in (('json', dict(blogs=blogs)), ('template', {'__template__': 'test.html', 'users': users})):
+        async def handler(req, data=data):
+            return data
+        middleware = await response_factory(app, handler)
+        result['%s_us' % name] = await measure_async(lambda: middleware(request), number)
+    return result
+
+
+async def run(number):
+    return {
+        'micro.models': bench_models(number),
+        'micro.binding': await bench_binding(number),
+        'micro.encoding': await bench_encoding(number),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro benchmarks')
+    parser.add_argument('--number', type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.get_event_loop().run_until_complete(run(args.number))
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  端到端基准: 进程内启动app.init创建的应用(默认sqlite内存库), 并发请求JSON接口, 模板页面和静态文件
+    python -m benchmarks.pipeline [--requests 2000] [--concurrency 16] [--rows 200] [--page-cache]
+  结果以JSON输出: 每个接口的rps(请求/秒), p50_ms, p99_ms, mean_ms
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from blogs import app as webapp
+from blogs import compress, page_cache
+from blogs.CoroutineWeb import add_route, get
+from blogs.entity import Blog, Customer
+
+__author__ = 'boris han'
+
+
+@get('/bench/api/blogs')
+async def api_blogs(*, limit='20'):
+    return dict(blogs=await Blog.find_all(order_by='`created_at` desc', limit=int(limit)))
+
+
+def make_static(path):
+    """
+    生成静态文件并预压缩
+    :return: 文件名
+    """
+    name = 'bench.css'
+    with open(os.path.join(path, name), 'w') as f:
+        for i in range(2000):
+            f.write('.item-%s { color: #%06x; margin: %spx; }\n' % (i, i * 997 % 0xffffff, i % 16))
+    compress.precompress(path)
+    return name
+
+
+async def seed(rows):
+    now = time.time()
+    await Customer.save_many([Customer(name='user%s' % i, email='user%s@example.com' % i, created_at=now - i)
+                              for i in range(rows)])
+    await Blog.save_many([Blog(name='blog%s' % i, summary='summary ' * 20, content='content ' * 200,
+                               created_at=now - i) for i in range(rows)])
+
+
+def percentile(values, q):
+    """
+    :param values: 已排序
+    :param q: 0-1
+    """
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def load(client, path, requests, concurrency, headers=None):
+    """
+    concurrency个协程并发发起共requests个请求
+    :return: dict(rps, p50_ms, p99_ms, mean_ms)
+    """
+    latencies = []
+    remaining = [requests]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            resp = await client.get(path, headers=headers)
+            await resp.read()
+            latencies.append(time.perf_counter() - start)
+            if resp.status != 200:
+                raise RuntimeError('%s returned %s' % (path, resp.status))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return dict(rps=requests / elapsed, p50_ms=percentile(latencies, 0.5) * 1e3,
+                p99_ms=percentile(latencies, 0.99) * 1e3, mean_ms=sum(latencies) / len(latencies) * 1e3)
+
+
+async def run(requests, concurrency, rows, use_page_cache=False):
+    app = await webapp.init(asyncio.get_event_loop())
+    add_route(app, api_blogs)
+    # 默认关闭页面缓存, 测量handler, ORM和渲染本身
+    page_cache.configure(enabled=use_page_cache)
+    static_dir = tempfile.mkdtemp(prefix='blogs-bench-')
+    static = make_static(static_dir)
+    app.router.add_get('/bench/static/{filename:.*}', compress.static_handler(static_dir))
+    await seed(rows)
+    endpoints = (
+        ('pipeline.json', '/bench/api/blogs?limit=20', None),
+        ('pipeline.template', '/', None),
+        ('pipeline.static', '/bench/static/%s' % static, None),
+        ('pipeline.static_gzip', '/bench/static/%s' % static, {'Accept-Encoding': 'gzip'}),
+    )
+    results = dict()
+    async with TestClient(TestServer(app)) as client:
+        for name, path, headers in endpoints:
+            # 预热: 模板编译, 连接建立
+            await load(client, path, min(requests, 50), concurrency, headers)
+            results[name] = await load(client, path, requests, concurrency, headers)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end request pipeline benchmark')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rows', type=int, default=200)
+    parser.add_argument('--page-cache', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.get_event_loop().run_until_complete(
+        run(args.requests, args.concurrency, args.rows, args.page_cache))
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  dict实体与__slots__行对象对比: 每行内存占用, 由tuple行构造的耗时, 属性访问耗时
+    python -m benchmarks.rows [--rows 10000]
+  结果以JSON输出
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from blogs.entity import Blog
+
+__author__ = 'boris han'
+
+
+def make_tuples(rows):
+    now = time.time()
+    return [('%050d' % i, '%050d' % (i % 100), 'user%s' % (i % 100), 'http://www.gravatar.com/avatar/%s' % i,
+             'blog%s' % i, 'summary', 'content', now - i) for i in range(rows)]
+
+
+def measure(decode, tuples):
+    """
+    :return: (每行字节数, 每行构造微秒, 每次属性访问纳秒)
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = decode(tuples)
+    per_row = (tracemalloc.get_traced_memory()[0] - before) / len(tuples)
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    decode(tuples)
+    build_us = (time.perf_counter() - start) / len(tuples) * 1e6
+
+    start = time.perf_counter()
+    for obj in objs:
+        obj.name
+        obj.summary
+        obj.created_at
+    access_ns = (time.perf_counter() - start) / (len(objs) * 3) * 1e9
+    return per_row, build_us, access_ns
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model vs __row__ benchmark')
+    parser.add_argument('--rows', type=int, default=10000)
+    args = parser.parse_args()
+    tuples = make_tuples(args.rows)
+    plan = Blog.compile_select()
+    results = dict()
+    for name, decode in (('model', plan.decode), ('row', plan.decode_rows)):
+        per_row, build_us, access_ns = measure(decode, tuples)
+        results[name] = dict(bytes_per_row=per_row, build_us_per_row=build_us, attribute_access_ns=access_ns)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
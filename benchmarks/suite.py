@@ -0,0 +1,100 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  基准测试套件: 依次运行micro和pipeline, 结果以JSON输出; 指定基线时逐项对比, 标记退化
+    python -m benchmarks.suite --output current.json
+    python -m benchmarks.suite --baseline baseline.json [--tolerance 0.15]
+  指标名以rps结尾的越大越好, 其余(耗时)越小越好; 有退化时退出码为1, 可用于CI
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks import micro, pipeline
+
+__author__ = 'boris han'
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def higher_is_better(name):
+    return name.endswith('rps')
+
+
+def compare(baseline, current, tolerance):
+    """
+    对比两次结果
+    :param baseline: 基线结果的results部分
+    :param current: 本次结果的results部分
+    :param tolerance: 允许的相对变化, 如0.1表示10%
+    :return: [dict(name, baseline, current, change, regression)], change为相对变化
+    """
+    rows = []
+    for group, values in sorted(current.items()):
+        for key, value in sorted(values.items()):
+            base = baseline.get(group, {}).get(key)
+            if not base:
+                continue
+            change = (value - base) / base
+            if higher_is_better(key):
+                regression = change < -tolerance
+            else:
+                regression = change > tolerance
+            rows.append(dict(name='%s.%s' % (group, key), baseline=base, current=value, change=change,
+                             regression=regression))
+    return rows
+
+
+async def run(args):
+    results = dict()
+    results.update(await micro.run(args.number))
+    results.update(await pipeline.run(args.requests, args.concurrency, args.rows))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark suite')
+    parser.add_argument('--number', type=int, default=1000, help='micro benchmark iterations')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rows', type=int, default=200, help='seeded customers and blogs')
+    parser.add_argument('--output', help='write results to this file')
+    parser.add_argument('--baseline', help='compare with results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    report = dict(meta=dict(commit=git_commit(), python=platform.python_version(), platform=platform.platform(),
+                            time=time.strftime('%Y-%m-%dT%H:%M:%S')),
+                  results=asyncio.get_event_loop().run_until_complete(run(args)))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['comparison'] = compare(baseline['results'], report['results'], args.tolerance)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+    regressions = [row for row in report.get('comparison', []) if row['regression']]
+    for row in regressions:
+        logging.warning('regression %s: %.4g => %.4g (%+.1f%%)'
+                        % (row['name'], row['baseline'], row['current'], row['change'] * 100))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
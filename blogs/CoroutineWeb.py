@@ -7,22 +7,29 @@
 """
 import asyncio
 import functools
+import importlib
+import importlib.util
 import inspect
+import json
 import logging
 import os
-from urllib import parse
+import time
 
 from aiohttp import web
 
+from blogs import codec, compress, metrics, tracing
 from blogs.apis import APIError
 
 __author__ = 'boris han'
 
 
-def get(path):
+def get(path, cache=None, coalesce=None):
     """
     自定义装饰器@get('/path')
     :param path: url路径
+    :param cache: 页面缓存设置, None使用配置的默认值, False不缓存, True或秒数开启, 见page_cache
+    :param coalesce: 参数相同的并发请求是否共用一次handler调用, 默认None不合并;
+                     只对结果不依赖cookie等请求状态的热点页面开启
     :return:
     """
 
@@ -35,6 +42,10 @@ def get(path):
         wrapper.__method__ = 'GET'
         # 添加请求URL
         wrapper.__route__ = path
+        # 页面缓存设置
+        wrapper.__cache__ = cache
+        # 并发请求合并
+        wrapper.__coalesce__ = coalesce
         return wrapper
 
     return decorator
@@ -61,94 +72,179 @@ def post(path):
     return decorator
 
 
-def has_request_arg(fn):
+def inspect_handler(fn):
     """
-    判断是否有request参数
-    :param fn:
-    :return:
+    一次inspect.signature得到RequestHandler需要的全部参数信息, 结果可以JSON序列化, 缓存在路由清单中
+    :param fn: 函数对象
+    :return: dict
     """
-    # 获取对象或函数的信息
     signature = inspect.signature(fn)
-    # 当前函数参数列表
-    parameters = signature.parameters
-    found = False
-    for name, param in parameters.items():
+    has_request = False
+    var_kwarg = False
+    named = []
+    required = []
+    for name, param in signature.parameters.items():
+        if param.kind == inspect.Parameter.VAR_KEYWORD:
+            var_kwarg = True
+        elif param.kind == inspect.Parameter.KEYWORD_ONLY:
+            named.append(name)
+            if param.default == inspect.Parameter.empty:
+                required.append(name)
         if name == 'request':
-            found = True
+            has_request = True
             continue
-
-        # VAR_POSITIONAL - 可变参数 | KEYWORD_ONLY - 命名关键字参数 | VAR_KEYWORD - 关键字参数
-        if found and (param.kind != inspect.Parameter.VAR_POSITIONAL
-                      and param.kind != inspect.Parameter.KEYWORD_ONLY
-                      and param.kind != inspect.Parameter.VAR_KEYWORD):
+        if has_request and (param.kind != inspect.Parameter.VAR_POSITIONAL
+                            and param.kind != inspect.Parameter.KEYWORD_ONLY
+                            and param.kind != inspect.Parameter.VAR_KEYWORD):
             raise ValueError('request parameter must be the last named parameter in function:%s%s'
                              % (fn.__name__, str(signature)))
+    return dict(parameters=list(signature.parameters.keys()), has_request_arg=has_request,
+                has_var_kwarg=var_kwarg, named_kwarg=named, required_kwarg=required,
+                is_asyncgen=inspect.isasyncgenfunction(inspect.unwrap(fn)))
 
 
-def has_var_kwarg(fn):
-    """
-    判断指定函数是否包含关键字参数
-    :param fn: 函数对象
-    :return:
-    """
-    parameters = inspect.signature(fn).parameters
-    for key, name in parameters.items():
-        if name.kind == inspect.Parameter.VAR_KEYWORD:
-            return True
-
-
-def has_named_kwarg(fn):
+def mark_coroutine(handler):
     """
-    判断指定函数是否包含命名关键字参数
-    :param fn: 函数对象
-    :return:
+    aiohttp 3把非协程函数的handler包装为必须返回StreamResponse, dict等结果到不了response_factory
+    可调用对象需要标记为协程函数
     """
-    params = inspect.signature(fn).parameters
-    for name, param in params.items():
-        if param.kind == inspect.Parameter.KEYWORD_ONLY:
-            return True
+    if hasattr(inspect, 'markcoroutinefunction'):
+        inspect.markcoroutinefunction(handler)
+    else:
+        handler._is_coroutine = asyncio.coroutines._is_coroutine
 
 
-def get_named_kwarg(fn):
+def read_query(request):
     """
-    获得命名关键字参数
-    :param fn:
-    :return:
+    GET请求参数, 同名参数取第一个值
+    :param request:
+    :return: dict, 没有查询参数时返回None
     """
-    args = []
-    parameters = inspect.signature(fn).parameters
-    for name, param in parameters.items():
-        if param.kind == inspect.Parameter.KEYWORD_ONLY:
-            args.append(name)
-    # 返回一个不不可变的tuple
-    return tuple(args)
+    if not request.query_string:
+        return None
+    kw = dict()
+    for key, value in request.query.items():
+        kw.setdefault(key, value)
+    return kw
 
 
-def get_required_kwarg(fn):
+async def read_body(request):
     """
-    获取必填的关键字参数(即没有默认值的关键字参数)
-    :param fn: 函数对象
-    :return:
+    POST请求参数, 支持json和表单
+    :param request:
+    :return: dict
     """
-    args = []
-    parameters = inspect.Signature(fn).parameters
-    for name, param in parameters.items():
-        # 关键字参数且默认值为空 = 必填关键字参数
-        if param.kind == inspect.Parameter.VAR_KEYWORD and param.default == inspect.Parameter.empty:
-            args.append(name)
-    return tuple(args)
+    if not request.content_type:
+        logging.error('Missing content type.')
+        raise web.HTTPBadRequest()
+    content_type = request.content_type.lower()
+    if content_type.startswith('application/json'):
+        params = await request.json(loads=codec.loads)
+        if not isinstance(params, dict):
+            logging.error('JSON body must be object.')
+            raise web.HTTPBadRequest()
+        return params
+    if content_type.startswith('application/x-www-form-urlencoded') or \
+            content_type.startswith('multipart/form-data'):
+        return dict(await request.post())
+    logging.error('Unsupported content type:%s.' % request.content_type)
+    raise web.HTTPBadRequest()
 
 
 class RequestHandler(object):
 
-    def __init__(self, app, fn):
+    def __init__(self, app, fn, spec=None):
+        """
+        :param app:
+        :param fn: handler函数
+        :param spec: inspect_handler(fn)的结果, 来自路由清单时不再inspect
+        """
         self._app = app
         self._func = fn
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kwarg = has_var_kwarg(fn)
-        self._has_named_kwarg = has_named_kwarg(fn)
-        self._named_kwarg = get_named_kwarg(fn)
-        self._required_kwarg = get_required_kwarg(fn)
+        # 页面缓存设置, 中间件通过request.match_info.handler读取
+        self.cache = getattr(fn, '__cache__', None)
+        if spec is None:
+            spec = inspect_handler(fn)
+        self._has_request_arg = spec['has_request_arg']
+        self._has_var_kwarg = spec['has_var_kwarg']
+        self._has_named_kwarg = bool(spec['named_kwarg'])
+        self._named_kwarg = tuple(spec['named_kwarg'])
+        self._required_kwarg = tuple(spec['required_kwarg'])
+        # 异步生成器函数不需要await, 直接返回生成器
+        self._is_asyncgen = spec['is_asyncgen']
+        method = getattr(fn, '__method__', None)
+        self._route = getattr(fn, '__route__', '')
+        self._bind, self._bind_async = self.compile_binder(method, self._route)
+        # 只合并GET请求, 异步生成器不能被多个请求共同消费
+        self._coalesce = bool(getattr(fn, '__coalesce__', None)) and method == 'GET' and not self._is_asyncgen
+        # 参数 => 执行中调用的结果future
+        self._inflight = dict()
+        mark_coroutine(self)
+
+    def compile_binder(self, method, route):
+        """
+        注册时根据函数签名和请求方式生成参数绑定函数, 请求时不再做任何判断
+        :param method: GET/POST
+        :param route: URL, 包含{name}时才需要合并match_info
+        :return: (绑定函数, 绑定函数是否为协程)
+        """
+        has_request = self._has_request_arg
+        has_match_info = '{' in route
+
+        # 只需要match_info和request
+        if not (self._has_var_kwarg or self._has_named_kwarg or self._required_kwarg):
+            if has_match_info and has_request:
+                def bind(request):
+                    kw = dict(request.match_info)
+                    kw['request'] = request
+                    return kw
+            elif has_match_info:
+                def bind(request):
+                    return dict(request.match_info)
+            elif has_request:
+                def bind(request):
+                    return {'request': request}
+            else:
+                def bind(request):
+                    return {}
+            return bind, False
+
+        named = self._named_kwarg if not self._has_var_kwarg else ()
+        required = self._required_kwarg
+
+        def complete(kw, request):
+            if kw is None:
+                kw = dict()
+            elif named:
+                # 移除所有的非命名关键字参数
+                kw = {name: kw[name] for name in named if name in kw}
+            if has_match_info:
+                for k, v in request.match_info.items():
+                    if k in kw:
+                        logging.warning('Duplicate arg name in named arg and kw args:%s' % k)
+                    kw[k] = v
+            if has_request:
+                kw['request'] = request
+            for name in required:
+                if name not in kw:
+                    logging.error('Missing argument: %s.' % name)
+                    raise web.HTTPBadRequest()
+            return kw
+
+        # 从请求体取参数
+        if method == 'POST':
+            async def bind(request):
+                return complete(await read_body(request), request)
+            return bind, True
+        # 从查询参数取参数
+        if method == 'GET':
+            def bind(request):
+                return complete(read_query(request), request)
+            return bind, False
+
+        def bind(request):
+            return complete(None, request)
+        return bind, False
 
     async def __call__(self, request):
         """
@@ -156,78 +252,123 @@ class RequestHandler(object):
         :param request: 请求
         :return:
         """
-        kw = None
-        if self._has_var_kwarg or self._has_named_kwarg or self._required_kwarg:
-            # POST请求
-            if request.method == 'POST':
-                if not request.content_type:
-                    logging.error('Missing content type.')
-                    return web.HTTPBadRequest()
-                content_type = request.content_type.lower()
-                if content_type.startwith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        logging.error('JSON body must be object.')
-                        return web.HTTPBadRequest()
-                    kw = params
-                elif content_type.startwith('application/x-www-form-urlencoded') or \
-                        content_type.startwith('multipart/form-data'):
-                    params = await request.post()
-                    kw = params
-                else:
-                    logging.error('Unsupported content type:%s.' % request.content_type)
-                    return web.HTTPBadRequest()
-            # GET请求
-            if request.method == 'GET':
-                query_params = request.query_string
-                if query_params:
-                    kw = dict()
-                    for key, value in parse.parse_qs(query_params, True).items():
-                        kw[key] = value[0]
-        if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kwarg and self._named_kwarg:
-                # 移除所有的非命名关键字参数
-                copy = dict()
-                for name in self._named_kwarg:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args:%s' % k)
-                kw[k] = v
-
-        if self._has_request_arg:
-            kw['request'] = request
-
-        if self._required_kwarg:
-            for name in self._required_kwarg:
-                if name not in kw:
-                    logging.error('Missing argument: %s.' % name)
-                    return web.HTTPBadRequest()
-        logging.info('call with args: %s ' % str(kw))
+        with tracing.span(tracing.BIND):
+            kw = self._bind(request)
+            if self._bind_async:
+                kw = await kw
+        logging.debug('call %s with args: %s', self._func.__name__, kw)
         try:
-            r = await self._func(**kw)
-            return r
+            if self._is_asyncgen:
+                return self._func(**kw)
+            with tracing.span(tracing.HANDLER):
+                if self._coalesce:
+                    return await self.single_flight(kw)
+                return await self._func(**kw)
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
+    async def single_flight(self, kw):
+        """
+        参数相同的并发请求共用一次handler调用, 都得到它的结果
+        第一个请求直接await handler(不创建Task), 结果通过future发布给等待中的请求;
+        第一个请求被取消(客户端断开)时, 等待中的请求各自重新调用handler
+        :param kw: 绑定后的参数
+        :return:
+        """
+        key = tuple(sorted((k, v) for k, v in kw.items() if k != 'request'))
+        stats = coalesce_stats.setdefault(self._route, [0, 0])
+        stats[0] += 1
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._inflight[key] = asyncio.get_event_loop().create_future()
+            try:
+                r = await self._func(**kw)
+            except asyncio.CancelledError:
+                future.set_result(_RETRY)
+                raise
+            except BaseException as e:
+                future.set_exception(e)
+                # 没有等待中的请求时避免输出exception was never retrieved
+                future.exception()
+                raise
+            else:
+                future.set_result(r)
+                return r
+            finally:
+                del self._inflight[key]
+        stats[1] += 1
+        # shield: 等待中的请求被取消时不取消共用的future
+        r = await asyncio.shield(future)
+        if r is _RETRY:
+            return await self._func(**kw)
+        if isinstance(r, web.Response) and isinstance(r.body, bytes):
+            # Response只能发送一次, 复制一份
+            return web.Response(status=r.status, headers=r.headers, body=r.body)
+        if isinstance(r, web.StreamResponse):
+            return await self._func(**kw)
+        return r
+
+
+# 路由 => [GET请求数, 被合并的请求数]
+coalesce_stats = dict()
+# 合并的调用被取消, 等待中的请求需要重新调用handler
+_RETRY = object()
+
+
+@metrics.register
+def coalesce_metrics():
+    lines = ['# HELP blogs_http_requests_coalesced_total GET requests served by another in-flight call.',
+             '# TYPE blogs_http_requests_coalesced_total counter']
+    for route, (calls, coalesced) in coalesce_stats.items():
+        lines.append('blogs_http_requests_coalesced_total{route="%s"} %s' % (metrics.escape(route), coalesced))
+    lines.append('# TYPE blogs_http_requests_single_flight_total counter')
+    for route, (calls, coalesced) in coalesce_stats.items():
+        lines.append('blogs_http_requests_single_flight_total{route="%s"} %s' % (metrics.escape(route), calls))
+    return lines
+
+
+def as_coroutine(fn):
+    """
+    将普通函数包装为协程函数
+    :param fn:
+    :return:
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return fn(*args, **kwargs)
 
-def add_static(app):
+    return wrapper
+
+
+def add_static(app, precompress=False):
     """
       添加静态资源路径
     :param app:
-    :param func:
+    :param precompress: 启动时预压缩静态文件, 按Accept-Encoding发送.gz/.br
     :return:
     """
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
+    if not os.path.isdir(path):
+        logging.warning('static path not found: %s.' % path)
+        return
+    if precompress:
+        compress.precompress(path)
+    app.router.add_get('/static/{filename:.*}', compress.static_handler(path))
     logging.info('add static: %s => %s.' % ('/static/', path))
 
 
+def prepare_handler(func):
+    """
+    普通函数包装为协程, 异步生成器直接返回给response_factory流式输出
+    :param func:
+    :return:
+    """
+    target = inspect.unwrap(func)
+    if not asyncio.iscoroutinefunction(target) and not inspect.isasyncgenfunction(target):
+        func = as_coroutine(func)
+    return func
+
+
 def add_route(app, func):
     """
       注册模块URL
@@ -239,32 +380,127 @@ def add_route(app, func):
     path = getattr(func, '__route__', None)
     if method is None or path is None:
         raise ValueError('@get or @post not defined in %s.' % str(func))
-    if not asyncio.iscoroutinefunction(func) and not inspect.iscoroutinefunction(func):
-        func = asyncio.coroutine(func)
+    func = prepare_handler(func)
+    handler = RequestHandler(app, func)
     logging.info('add route %s %s => %s(%s)' %
                  (method, path, func.__name__, ','.join(inspect.signature(func).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, func))
+    app.router.add_route(method, path, handler)
 
 
-def add_routes(app, module_name):
+# 路由清单格式版本, get/post或inspect_handler的结果变化时加1, 旧清单自动失效
+MANIFEST_VERSION = 1
+
+
+class LazyRequestHandler(object):
     """
-    将所有module_name模块全部注册
-    :param app:
-    :param module_name:
-    :return:
+      按路由清单注册的handler, 首次请求时才导入handler模块
     """
-    index = module_name.rfind('.')
-    if index == (-1):
-        mod = __import__(module_name, globals(), locals())
-    else:
-        name = module_name[index + 1]
-        mod = getattr(__import__(module_name[:index], globals(), locals(), [name]), name)
+
+    def __init__(self, app, module_name, entry):
+        self._app = app
+        self._module_name = module_name
+        self._entry = entry
+        self.cache = entry['cache']
+        self._handler = None
+        mark_coroutine(self)
+
+    def resolve(self):
+        if self._handler is None:
+            start = time.perf_counter()
+            func = getattr(importlib.import_module(self._module_name), self._entry['name'], None)
+            # 清单只能指向@get/@post声明的同一路由
+            if getattr(func, '__method__', None) != self._entry['method'] \
+                    or getattr(func, '__route__', None) != self._entry['path']:
+                raise RuntimeError('route manifest does not match %s.%s, delete the manifest.'
+                                   % (self._module_name, self._entry['name']))
+            func = prepare_handler(func)
+            self._handler = RequestHandler(self._app, func, self._entry['spec'])
+            logging.info('load handler %s.%s in %.1fms.' %
+                         (self._module_name, self._entry['name'], (time.perf_counter() - start) * 1e3))
+        return self._handler
+
+    async def __call__(self, request):
+        return await self.resolve()(request)
+
+
+def module_routes(mod):
+    """
+    模块中@get/@post声明的函数
+    :return: [(属性名, 函数)]
+    """
+    routes = []
     for attr in dir(mod):
         if attr.startswith('_'):
             continue
         func = getattr(mod, attr)
-        if callable(func):
-            method = getattr(func, '__method__', None)
-            path = getattr(func, '__route__', None)
-            if method and path:
-                add_route(app, func)
+        if callable(func) and getattr(func, '__method__', None) and getattr(func, '__route__', None):
+            routes.append((attr, func))
+    return routes
+
+
+def build_manifest(module_name):
+    """
+    导入模块, 生成路由清单
+    :param module_name:
+    :return: [dict(name, method, path, cache, coalesce, spec)]
+    """
+    mod = importlib.import_module(module_name)
+    return [dict(name=attr, method=func.__method__, path=func.__route__, cache=getattr(func, '__cache__', None),
+                 coalesce=getattr(func, '__coalesce__', None), spec=inspect_handler(func))
+            for attr, func in module_routes(mod)]
+
+
+def load_manifest(module_name, manifest_dir):
+    """
+    读取路由清单, 清单不存在或模块文件的mtime/大小变化时重新生成
+    只跟踪模块自身的文件, 从其他模块导入的handler修改后需要删除清单
+    :param module_name:
+    :param manifest_dir: 清单目录, None表示模块所在目录的__pycache__
+    :return: 路由清单
+    """
+    source = importlib.util.find_spec(module_name).origin
+    stat = os.stat(source)
+    manifest_dir = manifest_dir or os.path.join(os.path.dirname(source), '__pycache__')
+    key = dict(version=MANIFEST_VERSION, module=module_name, mtime=stat.st_mtime, size=stat.st_size)
+    path = os.path.join(manifest_dir, 'routes-%s.json' % module_name)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest['key'] == key:
+            return manifest['routes']
+    except (OSError, ValueError, KeyError):
+        pass
+    routes = build_manifest(module_name)
+    os.makedirs(manifest_dir, exist_ok=True)
+    # 多个worker同时启动, 先写临时文件再替换
+    tmp = '%s.%s' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(dict(key=key, routes=routes), f)
+    os.replace(tmp, path)
+    logging.info('route manifest written: %s.' % path)
+    return routes
+
+
+def add_routes(app, module_name, lazy=False, manifest_dir=None):
+    """
+    将所有module_name模块全部注册
+    :param app:
+    :param module_name:
+    :param lazy: 按路由清单注册, 首次请求时才导入模块; 清单有效时启动不导入模块, 也不inspect函数签名
+    :param manifest_dir: 清单目录, 默认模块所在目录的__pycache__, 与字节码缓存一样属于应用自身
+    :return:
+    """
+    if lazy:
+        try:
+            routes = load_manifest(module_name, manifest_dir)
+        except OSError as e:
+            # 清单目录不可读写时退回到启动时导入模块
+            logging.warning('route manifest unavailable, import %s eagerly: %s.' % (module_name, e))
+        else:
+            for entry in routes:
+                logging.info('add route %s %s => %s(%s)' %
+                             (entry['method'], entry['path'], entry['name'], ','.join(entry['spec']['parameters'])))
+                app.router.add_route(entry['method'], entry['path'], LazyRequestHandler(app, module_name, entry))
+            return
+    for attr, func in module_routes(importlib.import_module(module_name)):
+        add_route(app, func)
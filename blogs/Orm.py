@@ -1,11 +1,35 @@
 #!usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
+import base64
+import contextlib
+import contextvars
+import functools
+import json
 import logging
+import time
+from collections import OrderedDict
 
-import aiomysql
+from blogs import backends, loader, metrics, tracing
+from blogs.apis import APIError
+from blogs.cache import EntityCache
 
 __author__ = 'boris han'
 
+# 数据库后端, 见backends
+__backend = None
+__pool = None
+__replicas = []
+__read_strategy = 'round_robin'
+__read_your_writes = 1.0
+__next_replica = -1
+# 当前请求最近一次写操作的时间, aiohttp每个请求在独立的Task中处理, 互不影响
+_last_write = contextvars.ContextVar('last_write', default=None)
+# 当前上下文的事务, 见transaction()
+_transaction = contextvars.ContextVar('transaction', default=None)
+# 表名 => 实体缓存设置, 见configure_caches()
+_cache_settings = dict()
+
 
 def log_sql(sql, args=()):
     """
@@ -13,30 +37,393 @@ def log_sql(sql, args=()):
     :param sql: SQL
     :param args: None
     """
-    logging.info('SQL: %s, args: %s' % (sql, args))
+    logging.debug('SQL: %s, args: %s', sql, args)
 
 
-async def create_pool(init_loop, **kw):
+class Pool(object):
+    """
+    连接池包装: 统计连接数, 等待数和获取连接耗时
+    adaptive=True时按窗口内的平均等待时间调整常驻连接数(minsize), 在base minsize和maxsize之间增减
+    """
+
+    def __init__(self, name, pool, adaptive=False, adaptive_wait=0.005, adaptive_window=100, adaptive_step=1):
+        self.name = name
+        self.pool = pool
+        self.base_minsize = pool.minsize
+        self.waiters = 0
+        self.in_use = 0
+        self.acquire_latency = metrics.Histogram()
+        self.adaptive = adaptive
+        self.adaptive_wait = adaptive_wait
+        self.adaptive_window = adaptive_window
+        self.adaptive_step = adaptive_step
+        self._window_wait = 0.0
+        self._window_count = 0
+
+    async def warm(self):
+        """
+        预热: 同时获取minsize个连接后归还, 启动后的第一批请求不必等待建立连接
+        :return:
+        """
+        conns = await asyncio.gather(*[self.pool.acquire() for _ in range(self.pool.minsize)])
+        for conn in conns:
+            self.pool.release(conn)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """
+        获取连接
+        :return: (连接, 等待连接的秒数)
+        """
+        start = time.perf_counter()
+        self.waiters += 1
+        try:
+            conn = await self.pool.acquire()
+        finally:
+            self.waiters -= 1
+        wait = time.perf_counter() - start
+        self.acquire_latency.observe(wait)
+        if self.adaptive:
+            self.adapt(wait)
+        self.in_use += 1
+        try:
+            yield conn, wait
+        finally:
+            self.in_use -= 1
+            self.pool.release(conn)
+
+    def adapt(self, wait):
+        """
+        每adaptive_window次获取连接调整一次minsize
+        :param wait: 本次等待秒数
+        :return:
+        """
+        self._window_wait += wait
+        self._window_count += 1
+        if self._window_count < self.adaptive_window:
+            return
+        mean = self._window_wait / self._window_count
+        self._window_wait = 0.0
+        self._window_count = 0
+        minsize = self.pool.minsize
+        if mean > self.adaptive_wait and minsize < self.pool.maxsize:
+            minsize = min(self.pool.maxsize, minsize + self.adaptive_step)
+        elif mean < self.adaptive_wait / 10 and minsize > self.base_minsize:
+            minsize = max(self.base_minsize, minsize - self.adaptive_step)
+        else:
+            return
+        logging.info('pool %s: mean wait %.4fs, minsize %s => %s.' % (self.name, mean, self.pool.minsize, minsize))
+        # 连接池没有公开修改minsize的接口, aiomysql获取连接时会自动补足到_minsize
+        self.pool._minsize = minsize
+
+    def stats(self):
+        size = self.pool.size
+        free = self.pool.freesize
+        latency = self.acquire_latency
+        return dict(size=size, free=free, in_use=self.in_use, waiters=self.waiters,
+                    minsize=self.pool.minsize, maxsize=self.pool.maxsize, acquires=latency.count,
+                    acquire_avg=latency.sum / latency.count if latency.count else 0.0)
+
+    def close(self):
+        self.pool.close()
+
+    async def wait_closed(self):
+        await self.pool.wait_closed()
+
+
+async def open_pool(name, init_loop, **kw):
     """
-    创建数据源连接
+    创建单个连接池
+    :param name: 连接池名称
     :param init_loop:
     :param kw: 连接参数
+    :return: Pool
+    """
+    pool = await __backend.create_pool(init_loop, **kw)
+    pool = Pool(name, pool, adaptive=kw.get('adaptive', False),
+                adaptive_wait=kw.get('adaptive_wait', 0.005),
+                adaptive_window=kw.get('adaptive_window', 100),
+                adaptive_step=kw.get('adaptive_step', 1))
+    if kw.get('warm', True):
+        await pool.warm()
+    return pool
+
+
+async def create_pool(init_loop, **kw):
+    """
+    创建数据源连接: 主库一个连接池, 每个只读从库一个连接池
+    :param init_loop:
+    :param kw: 连接参数, 见config_default的db部分
+        replicas: 从库list, 每项为覆盖主库参数的dict, 如[{'host': '10.0.0.2'}]
+        read_strategy: 从库选择策略, round_robin轮询 | least_conn当前连接最少
+        read_your_writes: 写操作后该秒数内, 同一请求的读操作仍走主库
+        backend: 数据库后端, mysql | sqlite
     :return:
     """
     logging.info("create database connection pool...")
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=init_loop
-    )
+    global __backend, __pool, __replicas, __read_strategy, __read_your_writes
+    __backend = backends.get_backend(kw.pop('backend', 'mysql'))
+    replicas = kw.pop('replicas', None) or []
+    __read_strategy = kw.pop('read_strategy', 'round_robin')
+    __read_your_writes = kw.pop('read_your_writes', 1.0)
+    if __read_strategy not in ('round_robin', 'least_conn'):
+        raise ValueError('Invalid read strategy %s' % __read_strategy)
+    __pool = await open_pool('primary', init_loop, **kw)
+    __replicas = []
+    for i, replica in enumerate(replicas):
+        options = dict(kw)
+        options.update(replica)
+        __replicas.append(await open_pool('replica%s' % i, init_loop, **options))
+
+
+def all_pools():
+    if __pool is None:
+        return []
+    return [__pool] + __replicas
+
+
+def pool_stats():
+    """
+    连接池状态
+    :return: {连接池名称: 状态dict}
+    """
+    return {pool.name: pool.stats() for pool in all_pools()}
+
+
+@metrics.register
+def pool_metrics():
+    lines = []
+    stats = pool_stats()
+    for key in ('size', 'free', 'in_use', 'waiters', 'minsize', 'maxsize'):
+        lines.append('# TYPE blogs_db_pool_%s gauge' % key)
+        for name, values in stats.items():
+            lines.append('blogs_db_pool_%s{pool="%s"} %s' % (key, name, values[key]))
+    lines.append('# TYPE blogs_db_pool_acquire_seconds histogram')
+    for pool in all_pools():
+        lines.extend(pool.acquire_latency.samples('blogs_db_pool_acquire_seconds', 'pool="%s"' % pool.name))
+    return lines
+
+
+async def close_pool():
+    """
+    关闭数据源连接
+    :return:
+    """
+    global __pool, __replicas
+    for pool in all_pools():
+        pool.close()
+        await pool.wait_closed()
+    __pool = None
+    __replicas = []
+
+
+def mark_write():
+    """
+    记录当前请求(上下文)最近一次写操作的时间
+    :return:
+    """
+    _last_write.set(time.monotonic())
+
+
+def read_pool():
+    """
+    选择读连接池: 没有从库, 或当前请求刚写过数据时使用主库
+    :return: Pool
+    """
+    if not __replicas:
+        return __pool
+    last_write = _last_write.get()
+    if last_write is not None and time.monotonic() - last_write < __read_your_writes:
+        return __pool
+    if __read_strategy == 'least_conn':
+        return min(__replicas, key=lambda pool: pool.in_use + pool.waiters)
+    global __next_replica
+    __next_replica = (__next_replica + 1) % len(__replicas)
+    return __replicas[__next_replica]
+
+
+def acquire(read=False):
+    """
+    从连接池获取连接, 写操作总是使用主库; 当前上下文在事务中时使用事务的连接
+    :param read: 是否只读操作, 只读操作按read_strategy路由到从库
+    :return: async with acquire() as (连接, 等待连接池的秒数)
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        return tx.use()
+    if read:
+        return read_pool().acquire()
+    return __pool.acquire()
+
+
+class Transaction(object):
+    """
+    事务: 同一上下文中的ORM调用共用一个主库连接, 退出时统一提交
+    事务中不要用gather等方式并发执行SQL, 子任务会复制上下文而共用同一个连接
+    事务中写操作的实体缓存失效推迟到提交之后, 回滚时丢弃
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._savepoints = 0
+        # Model子类 => 待失效的主键list
+        self._invalidations = dict()
+
+    def invalidate_after_commit(self, model, keys):
+        """
+        提交前其他连接读到的仍是旧数据, 提交前失效缓存会被事务外的读取重新填入旧数据
+        :param model: Model子类
+        :param keys: 主键list
+        :return:
+        """
+        self._invalidations.setdefault(model, []).extend(keys)
+
+    def flush_invalidations(self):
+        invalidations, self._invalidations = self._invalidations, dict()
+        for model, keys in invalidations.items():
+            if model.__entity_cache__ is not None:
+                model.__entity_cache__.invalidate(*keys)
+
+    @contextlib.asynccontextmanager
+    async def use(self):
+        yield self.conn, 0.0
+
+    async def _execute(self, sql):
+        log_sql(sql)
+        async with self.conn.cursor() as cur:
+            await cur.execute(sql)
+
+    @contextlib.asynccontextmanager
+    async def savepoint(self):
+        """
+        保存点: 块内出错只回滚到保存点, 外层事务继续
+        :return:
+        """
+        self._savepoints += 1
+        name = 'sp_%s' % self._savepoints
+        await self._execute('SAVEPOINT %s' % name)
+        try:
+            yield self
+        except BaseException:
+            await self._execute('ROLLBACK TO SAVEPOINT %s' % name)
+            raise
+        else:
+            await self._execute('RELEASE SAVEPOINT %s' % name)
+        finally:
+            self._savepoints -= 1
+
+    async def commit(self):
+        """
+        分批提交: 提交已执行的SQL并开始新的事务, 用于大批量写入
+        :return:
+        """
+        if self._savepoints:
+            raise RuntimeError('Can not commit inside a savepoint')
+        await self.conn.commit()
+        self.flush_invalidations()
+        await self.conn.begin()
+
+
+@contextlib.asynccontextmanager
+async def transaction():
+    """
+    事务上下文, 其中所有Model方法和select/execute自动使用同一个连接:
+        async with Orm.transaction() as tx:
+            await blog.save()
+            await Comment.save_many(comments)
+    已在事务中时创建保存点
+    :return: Transaction
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        async with tx.savepoint():
+            yield tx
+        return
+    async with __pool.acquire() as (conn, wait):
+        await conn.begin()
+        tx = Transaction(conn)
+        token = _transaction.set(tx)
+        try:
+            yield tx
+        except BaseException:
+            logging.error('事务执行失败, 回滚!')
+            await conn.rollback()
+            raise
+        else:
+            await conn.commit()
+            tx.flush_invalidations()
+        finally:
+            _transaction.reset(token)
+
+
+def in_transaction():
+    return _transaction.get() is not None
+
+
+@functools.lru_cache(maxsize=512)
+def translate_sql(sql):
+    """
+    将?占位符转换为%s(aiomysql的格式), 同一条SQL只转换一次
+    :param sql: 使用?占位符的SQL
+    :return:
+    """
+    return sql.replace('?', '%s')
+
+
+async def fetch(sql, args, size=None, cursor=backends.DICT, primary=False):
+    """
+    执行已转换占位符的查询
+    :param sql: 使用%s占位符的SQL
+    :param args: 查询参数
+    :param size: 限制查询条数
+    :param cursor: 游标类型, 默认返回dict, backends.TUPLE返回tuple
+    :param primary: 读主库, 用于结果要写入实体缓存的查询
+    :return:
+    """
+    log_sql(sql, args)
+    with tracing.span(tracing.SQL):
+        async with acquire(read=not primary) as (conn, wait):
+            start = time.perf_counter()
+            async with conn.cursor(__backend.cursors[cursor]) as cur:
+                await cur.execute(sql, args or ())
+                if size:
+                    rs = await cur.fetchmany(size)
+                else:
+                    rs = await cur.fetchall()
+            metrics.observe_query(sql, args, time.perf_counter() - start, len(rs), wait)
+            logging.debug('row return: %s', len(rs))
+            return rs
+
+
+async def iterate(sql, args, batch, cursor=backends.STREAM):
+    """
+    服务端游标逐批读取结果集, 内存中最多保留batch行
+    :param sql: 使用%s占位符的SQL
+    :param args: 查询参数
+    :param batch: 每批行数
+    :param cursor: 游标类型, 默认服务端游标
+    :return: 异步迭代器, 每次返回一批行
+    """
+    log_sql(sql, args)
+    async with acquire(read=True) as (conn, wait):
+        # 只统计数据库耗时, 不含调用方处理每批数据的时间
+        elapsed = 0.0
+        rows = 0
+        try:
+            # 未读完的结果集在退出时由close()丢弃, 之后连接才能归还连接池
+            async with conn.cursor(__backend.cursors[cursor]) as cur:
+                start = time.perf_counter()
+                await cur.execute(sql, args or ())
+                while True:
+                    rs = await cur.fetchmany(batch)
+                    elapsed += time.perf_counter() - start
+                    if not rs:
+                        break
+                    rows += len(rs)
+                    yield rs
+                    start = time.perf_counter()
+        finally:
+            metrics.observe_query(sql, args, elapsed, rows, wait)
 
 
 # select
@@ -48,18 +435,7 @@ async def select(sql, args, size=None):
     :param size: 限制查询条数
     :return:
     """
-    log_sql(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        cursor = await conn.cursor(aiomysql.DictCursor)
-        await cursor.execute(sql.repalce('?', '%s' % (args or ())))
-        if size:
-            rs = await cursor.fetchmany(size)
-        else:
-            rs = await cursor.fetchall()
-        await cursor.close()
-        logging.info('row return: %s' % len(rs))
-        return rs
+    return await fetch(translate_sql(sql), args, size)
 
 
 # insert update delete
@@ -68,25 +444,67 @@ async def execute(sql, args, auto_commit=True):
     执行sql, 返回结果数量
     :param sql: 要执行的SQL脚本
     :param args: 参数
-    :param auto_commit: 是否自动提交
+    :param auto_commit: 是否自动提交, False时在事务中执行(已在事务中时使用保存点)
     :return:
     """
-    log_sql(sql)
-    async with __pool.get() as conn:
-        if not auto_commit:
-            await conn.begin()
-        try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
-                affected = cur.rowcount
-            if not auto_commit:
-                await conn.commit()
-        except BaseException as e:
-            logging.error('执行数据库脚本失败!', e)
-            if not auto_commit:
-                await conn.rollback()
-            raise
-        return affected
+    if not auto_commit:
+        async with transaction():
+            return await execute(sql, args)
+    sql = translate_sql(sql)
+    log_sql(sql, args)
+    with tracing.span(tracing.SQL):
+        async with acquire() as (conn, wait):
+            mark_write()
+            start = time.perf_counter()
+            try:
+                async with conn.cursor() as cur:
+                    await cur.execute(sql, args)
+                    affected = cur.rowcount
+            except BaseException:
+                logging.error('执行数据库脚本失败!')
+                raise
+            metrics.observe_query(sql, args, time.perf_counter() - start, affected, wait)
+            return affected
+
+
+# 批量 insert update delete
+async def execute_batch(statements):
+    """
+    在同一个事务中依次执行多条SQL, 任意一条失败全部回滚(已在事务中时回滚到保存点)
+    :param statements: [(sql, args, many)], many为True时args为参数序列, 使用executemany
+    :return: 影响的总行数
+    """
+    affected = 0
+    with tracing.span(tracing.SQL):
+        async with transaction():
+            async with acquire() as (conn, wait):
+                mark_write()
+                async with conn.cursor() as cur:
+                    for sql, args, many in statements:
+                        sql = translate_sql(sql)
+                        # executemany的参数只记录行数
+                        log_args = '%s rows' % len(args) if many else args
+                        log_sql(sql, log_args)
+                        start = time.perf_counter()
+                        if many:
+                            await cur.executemany(sql, args)
+                        else:
+                            await cur.execute(sql, args)
+                        affected += cur.rowcount
+                        metrics.observe_query(sql, log_args, time.perf_counter() - start, cur.rowcount, wait)
+                        wait = 0.0
+    return affected
+
+
+def chunks(items, size):
+    """
+    按size切分list
+    :param items:
+    :param size:
+    :return:
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 # 创建SQL时属性对应的具体值
@@ -97,6 +515,158 @@ def create_args_string(num):
     return ','.join(prepare_params)
 
 
+def limit_shape(limit):
+    """
+    limit参数的形态, 作为查询计划缓存key的一部分
+    :param limit: int或(offset, count)
+    :return: None | 'count' | 'range'
+    """
+    if not limit:
+        return None
+    if isinstance(limit, int):
+        return 'count'
+    if isinstance(limit, tuple) and len(limit) == 2:
+        return 'range'
+    raise ValueError('Invalid limit value %s' % str(limit))
+
+
+def limit_args(args, limit, shape):
+    """
+    where条件实际值复制一份后追加limit的条件值, 避免修改调用方的list
+    :param args: where条件值
+    :param limit: int或(offset, count)
+    :param shape: limit_shape()的返回值
+    :return:
+    """
+    args = list(args) if args else []
+    if shape == 'count':
+        args.append(limit)
+    elif shape == 'range':
+        args.extend(limit)
+    return args
+
+
+def encode_cursor(*values):
+    """
+    keyset分页游标编码, 对调用方不透明
+    :param values: 最后一行的排序列值
+    :return:
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, size):
+    """
+    keyset分页游标解码, 游标通常来自客户端, 无效时抛出APIError而不是服务端错误
+    :param cursor: encode_cursor()的返回值
+    :param size: 排序列个数
+    :return: 排序列值list
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, AttributeError):
+        raise APIError('value:invalid', 'after', 'Invalid page cursor')
+    if not isinstance(values, list) or len(values) != size \
+            or not all(isinstance(v, (str, int, float)) for v in values):
+        raise APIError('value:invalid', 'after', 'Invalid page cursor')
+    return values
+
+
+def make_row_class(name, columns):
+    """
+    生成紧凑的行对象类: 按列定义__slots__, 没有__dict__, 构造时按列顺序传入tuple行的值
+    :param name: 类名
+    :param columns: 列名tuple, 与查询结果列顺序一致
+    :return:
+    """
+    namespace = dict()
+    exec('def __init__(self, %s):\n%s' % (', '.join(columns), '\n'.join('    self.%s = %s' % (c, c) for c in columns)),
+         namespace)
+
+    def _asdict(self):
+        return {column: getattr(self, column) for column in columns}
+
+    def __repr__(self):
+        return '%s(%s)' % (name, ', '.join('%s=%r' % (column, getattr(self, column)) for column in columns))
+
+    return type(name, (object,), dict(__slots__=columns, __init__=namespace['__init__'],
+                                      _asdict=_asdict, __repr__=__repr__))
+
+
+# 预编译的查询计划: 已转换占位符的SQL + 行解码器
+class QueryPlan(object):
+
+    __slots__ = ('sql', 'columns', 'decode', 'decode_rows')
+
+    def __init__(self, model, sql, columns):
+        self.sql = translate_sql(sql)
+        self.columns = columns
+        row_class = model.__row__
+
+        def decode(rows):
+            return [model(zip(columns, row)) for row in rows]
+
+        def decode_rows(rows):
+            return [row_class(*row) for row in rows]
+
+        self.decode = decode
+        self.decode_rows = decode_rows
+
+
+# 查询计划缓存, key为(model, where, order_by, limit形态), 按LRU淘汰
+class StatementCache(object):
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+
+    def get(self, key, compiler):
+        """
+        获取查询计划, 不存在时调用compiler编译并缓存
+        :param key: 缓存key
+        :param compiler: 无参函数, 返回QueryPlan
+        :return:
+        """
+        plan = self._plans.get(key)
+        if plan is not None:
+            self.hits += 1
+            self._plans.move_to_end(key)
+            return plan
+        self.misses += 1
+        plan = compiler()
+        self._plans[key] = plan
+        if len(self._plans) > self.maxsize:
+            self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        self._plans.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._plans), hits=self.hits, misses=self.misses,
+                    hit_rate=self.hits / total if total else 0.0)
+
+
+statement_cache = StatementCache()
+
+# Model.aggregate支持的聚合函数
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'avg', 'min', 'max')
+
+
+@metrics.register
+def statement_cache_metrics():
+    stats = statement_cache.stats()
+    return ['# TYPE blogs_statement_cache_hits_total counter',
+            'blogs_statement_cache_hits_total %s' % stats['hits'],
+            '# TYPE blogs_statement_cache_misses_total counter',
+            'blogs_statement_cache_misses_total %s' % stats['misses']]
+
+
 # 属性对象(各种属性的父类)
 class Field(object):
 
@@ -135,7 +705,8 @@ class IntegerField(Field):
 class FloatField(Field):
     
     def __init__(self, name=None, default=0.0):
-        super(FloatField, self).__init__(name, 'float', False, default)
+        # MySQL的float为单精度, 时间戳使用real(double)
+        super(FloatField, self).__init__(name, 'real', False, default)
 
 
 # 映射Text类型字段
@@ -152,7 +723,7 @@ class ModelMetaClass(type):
         if name == 'Model':
             return type.__new__(mcs, name, bases, attrs)
         table_name = attrs.get('__table__', None) or name
-        logging.info('found model: %s (table: %s)' % (name, table_name))
+        logging.debug('found model: %s (table: %s)', name, table_name)
 
         # 字段映射
         mappings = dict()
@@ -161,7 +732,7 @@ class ModelMetaClass(type):
         primary_key = None
         for k, v in attrs.items():
             if isinstance(v, Field):
-                logging.info('  found mapping: %s ==> %s' % (k, v))
+                logging.debug('  found mapping: %s ==> %s', k, v)
                 mappings[k] = v
                 if v.primary_key:
                     # 找到主键:
@@ -182,18 +753,38 @@ class ModelMetaClass(type):
         attrs['__primary_key__'] = primary_key
         # 除主键外的属性名
         attrs['__fields__'] = fields
+        # keyset分页的排序列, 默认created_at, 与主键组合保证顺序唯一
+        keyset = attrs.get('__keyset__', 'created_at')
+        attrs['__keyset__'] = keyset if keyset in mappings else None
+        # 查询结果列顺序, 与__select__一致, 用于tuple行解码
+        attrs['__columns__'] = tuple([primary_key] + fields)
+        # 紧凑行对象类, find_all(as_rows=True)时使用
+        attrs['__row__'] = make_row_class(name + 'Row', attrs['__columns__'])
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primary_key, ', '.join(escaped_fields), table_name)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (table_name, ', '.join(escaped_fields), primary_key, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (table_name, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primary_key)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (table_name, primary_key)
+        # 实体缓存: __cache__ = True 或 dict(maxsize=1000, ttl=60), 配置的设置优先, 见configure_caches
+        cache = _cache_settings.get(table_name, attrs.get('__cache__', None))
+        if isinstance(cache, dict) and not cache.get('maxsize', 1000):
+            cache = None
+        if cache:
+            attrs['__entity_cache__'] = EntityCache(**(cache if isinstance(cache, dict) else {}))
+        else:
+            attrs['__entity_cache__'] = None
         return type.__new__(mcs, name, bases, attrs)
 
 
 # 基类, 所有实体类都继承该类, 会通过ModelMetaClass自动扫描映射关系
 class Model(dict, metaclass=ModelMetaClass):
 
-    def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+    # 批量操作每批的行数, 子类可覆盖
+    __batch_size__ = 500
+    # 实体缓存, 子类通过__cache__开启
+    __entity_cache__ = None
+
+    def __init__(self, *args, **kw):
+        super(Model, self).__init__(*args, **kw)
 
     def __getattr__(self, key):
         try:
@@ -217,47 +808,204 @@ class Model(dict, metaclass=ModelMetaClass):
                 setattr(self, key, value)
         return value
 
+    @classmethod
+    def compile_select(cls, where=None, order_by=None, shape=None):
+        """
+        编译查询计划, 同一组(where, order_by, limit形态)只编译一次
+        :param where:
+        :param order_by:
+        :param shape: limit_shape()的返回值
+        :return: QueryPlan
+        """
+        def compiler():
+            sql = [cls.__select__]
+            if where:
+                sql.append(' where ')
+                sql.append(where)
+            if order_by:
+                sql.append(' order by ')
+                sql.append(order_by)
+            if shape == 'count':
+                sql.append(' limit ?')
+            elif shape == 'range':
+                sql.append(' limit ?, ?')
+            return QueryPlan(cls, ''.join(sql), cls.__columns__)
+
+        return statement_cache.get((cls, where, order_by, shape), compiler)
+
+    @classmethod
+    def cache_stats(cls):
+        """
+        实体缓存命中率统计, 未开启缓存时返回None
+        :return:
+        """
+        cache = cls.__entity_cache__
+        return None if cache is None else cache.stats()
+
+    @classmethod
+    async def find(cls, pk):
+        """
+        根据主键查询对象, 开启缓存时优先读取缓存, 未命中时从主库读取
+        :param pk: 主键
+        :return: 对象, 不存在时返回None
+        """
+        # 事务中读到的可能是未提交的数据, 不读写缓存
+        # 写入缓存的结果从主库读取: 从库延迟时, 失效后读到的旧数据会在缓存中保留ttl秒
+        cache = cls.__entity_cache__ if not in_transaction() else None
+        if cache is not None:
+            obj = cache.rows.get(pk)
+            if obj is not None:
+                # 返回副本, 调用方修改对象不会污染缓存
+                return cls(obj)
+            generation = cache.generation
+        plan = cls.compile_select('`%s`=?' % cls.__primary_key__)
+        rs = await fetch(plan.sql, [pk], 1, cursor=backends.TUPLE, primary=cache is not None)
+        if not rs:
+            return None
+        obj = plan.decode(rs)[0]
+        # 查询期间有写操作时结果可能已过期, 不写入缓存
+        if cache is not None and cache.generation == generation:
+            cache.rows.set(pk, cls(obj))
+        return obj
+
+    @classmethod
+    async def find_many(cls, pks):
+        """
+        根据主键批量查询, 每__batch_size__个主键一条 where pk in (...), 开启缓存时优先读取缓存, 未命中时从主库读取
+        :param pks: 主键list
+        :return: {主键: 对象}, 不存在的主键不在结果中
+        """
+        cache = cls.__entity_cache__ if not in_transaction() else None
+        result = dict()
+        missing = []
+        for pk in dict.fromkeys(pks):
+            obj = cache.rows.get(pk) if cache is not None else None
+            if obj is None:
+                missing.append(pk)
+            else:
+                result[pk] = cls(obj)
+        pk_name = cls.__primary_key__
+        generation = cache.generation if cache is not None else None
+        for chunk in chunks(missing, cls.__batch_size__):
+            plan = cls.compile_select('`%s` in (%s)' % (pk_name, create_args_string(len(chunk))))
+            rs = await fetch(plan.sql, chunk, cursor=backends.TUPLE, primary=cache is not None)
+            fresh = cache is not None and cache.generation == generation
+            for obj in plan.decode(rs):
+                result[obj[pk_name]] = obj
+                if fresh:
+                    cache.rows.set(obj[pk_name], cls(obj))
+        return result
+
+    @classmethod
+    def load(cls, pk):
+        """
+        请求内批量加载: 同一轮事件循环内的load()合并为一次find_many(), 同一请求内相同主键只查询一次
+            customers = await asyncio.gather(*[Customer.load(c.customer_id) for c in comments])
+        同一请求内多次load()同一主键返回同一对象, 不要修改
+        :param pk: 主键
+        :return: future, 结果为对象, 不存在时为None
+        """
+        return loader.get_loader((cls, cls.__primary_key__), cls.find_many).load(pk)
+
+    @classmethod
+    async def load_many(cls, pks):
+        """
+        批量load()
+        :param pks: 主键list
+        :return: 对象list, 与pks一一对应, 不存在时为None
+        """
+        return list(await asyncio.gather(*[cls.load(pk) for pk in pks]))
+
     @classmethod
     async def find_all(cls, where=None, args=None, **kw):
         """
-        根据where条件查询对象
+        根据where条件查询对象, 开启缓存时优先读取缓存, 未命中时从主库读取
         :param where:
         :param args:
-        :param kw:
+        :param kw: order_by, limit; 或keyset分页的after, page_size(此时返回(对象list, 下一页游标));
+                   as_rows=True时返回__row__对象, 占用内存更少, 属性访问更快, 不经过实体缓存
         :return:
         """
-        sql = [cls.__select__]
-        if where:
-            sql.append(' where ')
-            sql.append(where)
-
-        # where条件实际值, 若没有, 就声明为空list, 后面存放order by 和limit的条件值
-        if args is None:
-            args = []
+        if 'page_size' in kw:
+            if kw.get('limit', None) or kw.get('order_by', None):
+                raise ValueError('page_size can not be used with limit or order_by')
+            return await cls.find_page(where, args, kw.get('after', None), kw['page_size'])
         order_by = kw.get('order_by', None)
-        if order_by:
-            sql.append(' order by ')
-            sql.append(order_by)
         limit = kw.get('limit', None)
-        if limit:
-            sql.append(' limit ')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            if isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                # 将tuple添加到list中
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value %s' % str(limit))
-        rs = await select(''.join(sql), args)
-        return [cls(**r) for r in rs]
+        if kw.get('as_rows', False):
+            shape = limit_shape(limit)
+            plan = cls.compile_select(where, order_by, shape)
+            rs = await fetch(plan.sql, limit_args(args, limit, shape), cursor=backends.TUPLE)
+            return plan.decode_rows(rs)
+        cache = cls.__entity_cache__ if not in_transaction() else None
+        if cache is not None:
+            key = (where, tuple(args) if args else (), order_by, limit)
+            rs = cache.queries.get(key)
+            if rs is not None:
+                return [cls(obj) for obj in rs]
+            generation = cache.generation
+        shape = limit_shape(limit)
+        plan = cls.compile_select(where, order_by, shape)
+        rs = await fetch(plan.sql, limit_args(args, limit, shape), cursor=backends.TUPLE, primary=cache is not None)
+        objs = plan.decode(rs)
+        if cache is not None and cache.generation == generation:
+            cache.queries.set(key, [cls(obj) for obj in objs])
+        return objs
+
+    @classmethod
+    async def find_page(cls, where=None, args=None, after=None, page_size=20):
+        """
+        keyset分页: 按(__keyset__, 主键)倒序, 从after游标之后取page_size条
+        与limit offset不同, 任意页的代价都和第一页相同, 需要(__keyset__, 主键)联合索引
+        :param where:
+        :param args:
+        :param after: 上一页返回的游标, None表示第一页
+        :param page_size: 每页条数
+        :return: (对象list, 下一页游标), 没有下一页时游标为None
+        """
+        keyset, pk = cls.__keyset__, cls.__primary_key__
+        if keyset is None:
+            raise ValueError('Model %s has no keyset column for paging' % cls.__name__)
+        conditions = ['(%s)' % where] if where else []
+        args = list(args) if args else []
+        if after:
+            last_key, last_pk = decode_cursor(after, 2)
+            conditions.append('(`%s` < ? or (`%s` = ? and `%s` < ?))' % (keyset, keyset, pk))
+            args.extend([last_key, last_key, last_pk])
+        plan = cls.compile_select(' and '.join(conditions) or None, '`%s` desc, `%s` desc' % (keyset, pk), 'count')
+        # 多取一条判断是否有下一页
+        args.append(page_size + 1)
+        rs = await fetch(plan.sql, args, cursor=backends.TUPLE)
+        objs = plan.decode(rs[:page_size])
+        next_cursor = None
+        if len(rs) > page_size:
+            last = objs[-1]
+            next_cursor = encode_cursor(last[keyset], last[pk])
+        return objs, next_cursor
+
+    @classmethod
+    async def iter_all(cls, where=None, args=None, batch=500, **kw):
+        """
+        流式查询, 按batch分批返回对象list, 适用于导出等大结果集
+        :param where:
+        :param args:
+        :param batch: 每批对象数量
+        :param kw: order_by, limit, as_rows
+        :return: 异步迭代器: async for blogs in Blog.iter_all(batch=100)
+        """
+        limit = kw.get('limit', None)
+        shape = limit_shape(limit)
+        plan = cls.compile_select(where, kw.get('order_by', None), shape)
+        args = limit_args(args, limit, shape)
+        decode = plan.decode_rows if kw.get('as_rows', False) else plan.decode
+        async for rs in iterate(plan.sql, args, batch):
+            yield decode(rs)
 
     @classmethod
     async def find_total(cls, select_field, where=None, args=None):
         """
-        根据条件查询结果集数量
-        :param select_field:
+        根据条件查询结果集数量, 兼容旧接口, 新代码使用aggregate/count_in
+        :param select_field: 需要别名为__num__, 如 count(id) __num__
         :param where:
         :param args:
         :return:
@@ -271,10 +1019,123 @@ class Model(dict, metaclass=ModelMetaClass):
             return None
         return rs[0]['__num__']
 
-    async def save(self):
+    @classmethod
+    def check_column(cls, name):
+        if name not in cls.__columns__:
+            raise ValueError('Unknown column %s for model %s' % (name, cls.__name__))
+        return name
+
+    @classmethod
+    async def aggregate(cls, where=None, args=None, group_by=None, order_by=None, **aggregates):
+        """
+        聚合查询, 一次查询返回全部分组:
+            await Comment.aggregate(count='id', group_by='blog_id')
+            => [{'blog_id': '...', 'count': 3}, ...]
+        :param where:
+        :param args:
+        :param group_by: 分组字段名或字段名tuple
+        :param order_by:
+        :param aggregates: 聚合函数=字段名, 支持count/sum/avg/min/max, count可以使用'*'
+        :return: 没有group_by时返回一个dict, 否则返回dict list; 结果的key为分组字段名和聚合函数名
+        """
+        if not aggregates:
+            raise ValueError('No aggregate function specified')
+        if isinstance(group_by, str):
+            group_by = (group_by,)
+        group_by = tuple(group_by or ())
+        functions = tuple(sorted(aggregates.items()))
+
+        def compiler():
+            columns = ['`%s`' % cls.check_column(name) for name in group_by]
+            for function, field in functions:
+                if function not in AGGREGATE_FUNCTIONS:
+                    raise ValueError('Unsupported aggregate function %s' % function)
+                if field != '*' or function != 'count':
+                    field = '`%s`' % cls.check_column(field)
+                columns.append('%s(%s) as `%s`' % (function, field, function))
+            sql = ['select %s from `%s`' % (', '.join(columns), cls.__table__)]
+            if where:
+                sql.append(' where ')
+                sql.append(where)
+            if group_by:
+                sql.append(' group by ')
+                sql.append(', '.join('`%s`' % name for name in group_by))
+            if order_by:
+                sql.append(' order by ')
+                sql.append(order_by)
+            return translate_sql(''.join(sql))
+
+        sql = statement_cache.get((cls, 'aggregate', where, group_by, order_by, functions), compiler)
+        names = group_by + tuple(function for function, field in functions)
+        rs = await fetch(sql, list(args) if args else [], cursor=backends.TUPLE)
+        results = [dict(zip(names, row)) for row in rs]
+        if group_by:
+            return results
+        return results[0] if results else None
+
+    @classmethod
+    async def count_in(cls, field, values, where=None, args=None):
+        """
+        批量计数, 如列表页一次取得所有博客的评论数:
+            await Comment.count_in('blog_id', [blog.id for blog in blogs])
+            => {blog_id: 评论数}
+        :param field: 分组字段名
+        :param values: 分组字段的取值
+        :param where: 附加条件
+        :param args:
+        :return: {取值: 数量}, 没有记录的取值为0
+        """
+        values = list(dict.fromkeys(values))
+        if not values:
+            return {}
+        condition = '`%s` in (%s)' % (cls.check_column(field), create_args_string(len(values)))
+        if where:
+            condition = '(%s) and %s' % (where, condition)
+        args = (list(args) if args else []) + values
+        counts = {value: 0 for value in values}
+        for row in await cls.aggregate(condition, args, group_by=field, count='*'):
+            counts[row[field]] = row['count']
+        return counts
+
+    def insert_args(self):
+        """
+        __insert__对应的参数, 字段在前主键在后
+        :return:
+        """
         args = list(map(self.get_default_value, self.__fields__))
         args.append(self.get_default_value(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        return args
+
+    def update_args(self):
+        """
+        __update__对应的参数, 字段在前主键在后
+        :return:
+        """
+        args = list(map(self.get_default_value, self.__fields__))
+        args.append(self.get_value(self.__primary_key__))
+        return args
+
+    @classmethod
+    def invalidate_keys(cls, keys):
+        """
+        写操作后失效指定主键的缓存和全部查询缓存, 在事务中时推迟到提交之后
+        :param keys: 主键list
+        :return:
+        """
+        if cls.__entity_cache__ is None:
+            return
+        tx = _transaction.get()
+        if tx is not None:
+            tx.invalidate_after_commit(cls, keys)
+        else:
+            cls.__entity_cache__.invalidate(*keys)
+
+    def invalidate_cache(self):
+        self.invalidate_keys([self.get_value(self.__primary_key__)])
+
+    async def save(self):
+        rows = await execute(self.__insert__, self.insert_args())
+        self.invalidate_cache()
         if rows != 1:
             logging.warning('failed to insert record: affected rows: %s' % rows)
 
@@ -283,14 +1144,104 @@ class Model(dict, metaclass=ModelMetaClass):
         更新
         :return:
         """
-        args = list(map(self.get_default_value, self.__fields__))
-        args.append(self.get_value(self.__primary_key__))
-        row = await execute(self.__update__, args)
+        row = await execute(self.__update__, self.update_args())
+        self.invalidate_cache()
         if row != 1:
             logging.warning('failed to update record by primary_key: affected rows: %s' % row)
 
     async def remove(self):
         args = [self.get_value(self.__primary_key__)]
         row = await execute(self.__delete__, args)
+        self.invalidate_cache()
         if row != 1:
             logging.warning('failed to remove record by primary_key: affected rows: %s' % row)
+
+    @classmethod
+    async def save_many(cls, objs, batch_size=None):
+        """
+        批量插入, 按batch_size分批executemany(aiomysql会合并为多行insert), 在一个事务中提交
+        :param objs: 实体对象list
+        :param batch_size: 每批行数, 默认__batch_size__
+        :return: 插入的行数
+        """
+        rows = [obj.insert_args() for obj in objs]
+        if not rows:
+            return 0
+        size = batch_size or cls.__batch_size__
+        affected = await execute_batch([(cls.__insert__, chunk, True) for chunk in chunks(rows, size)])
+        cls.invalidate_keys([row[-1] for row in rows])
+        return affected
+
+    @classmethod
+    async def modify_many(cls, objs, batch_size=None):
+        """
+        批量更新, 在一个连接和事务中executemany
+        :param objs: 实体对象list
+        :param batch_size: 每批行数, 默认__batch_size__
+        :return: 更新的行数
+        """
+        rows = [obj.update_args() for obj in objs]
+        if not rows:
+            return 0
+        size = batch_size or cls.__batch_size__
+        affected = await execute_batch([(cls.__update__, chunk, True) for chunk in chunks(rows, size)])
+        cls.invalidate_keys([row[-1] for row in rows])
+        return affected
+
+    @classmethod
+    async def remove_many(cls, ids, batch_size=None):
+        """
+        根据主键批量删除, 每批一条delete ... in (...)语句
+        :param ids: 主键list
+        :param batch_size: 每批行数, 默认__batch_size__
+        :return: 删除的行数
+        """
+        ids = list(ids)
+        if not ids:
+            return 0
+        size = batch_size or cls.__batch_size__
+        # __delete__的where条件由`pk`=?改为`pk` in (?, ...)
+        prefix = cls.__delete__[:cls.__delete__.rindex('=')]
+        affected = await execute_batch([('%s in (%s)' % (prefix, create_args_string(len(chunk))), chunk, False)
+                                        for chunk in chunks(ids, size)])
+        cls.invalidate_keys(ids)
+        return affected
+
+
+def configure_caches(**settings):
+    """
+    按表名修改实体缓存设置, 参数见config_default的entity_cache部分
+    已定义的实体立即生效, 之后导入的实体在定义时使用
+    :param settings: 表名=dict(maxsize=1000, ttl=60), maxsize为0时关闭缓存
+    :return:
+    """
+    _cache_settings.update(settings)
+    for model in Model.__subclasses__():
+        options = settings.get(model.__table__)
+        if options is None:
+            continue
+        model.__entity_cache__ = EntityCache(**options) if options.get('maxsize', 1000) else None
+
+
+def create_table_sql(model):
+    """
+    根据字段的column_type生成建表语句, MySQL和SQLite通用
+    :param model: Model子类
+    :return:
+    """
+    columns = []
+    for name in model.__columns__:
+        field = model.__mappings__[name]
+        columns.append('  `%s` %s%s' % (name, field.column_type, ' not null' if field.primary_key else ''))
+    columns.append('  primary key (`%s`)' % model.__primary_key__)
+    return 'create table if not exists `%s` (\n%s\n)' % (model.__table__, ',\n'.join(columns))
+
+
+async def create_tables(*models):
+    """
+    创建不存在的表, 用于sqlite后端和测试环境
+    :param models: Model子类, 默认全部已导入的实体
+    :return:
+    """
+    for model in models or Model.__subclasses__():
+        await execute(create_table_sql(model), None)
@@ -4,22 +4,30 @@
 """
     异步框架
 """
-import json
 import logging
 import os
 import time
 import asyncio
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from datetime import datetime
-from blogs import Orm
+from blogs import Orm, codec, compress, loader, metrics, page_cache, tracing
+from blogs.config import configs, to_dict
 from blogs.CoroutineWeb import add_routes, add_static
 
 __author__ = 'boris han'
 
 
 def init_jinja2(app, **kw):
+    """
+      初始化模板引擎
+      生产环境: auto_reload=False不再检查模板文件修改, bytecode_cache将编译结果缓存到磁盘,
+      preload=True启动时编译全部模板, enable_async=True使用render_async渲染
+    :param app:
+    :param kw:
+    :return:
+    """
     logging.info('init jinja2...')
     options = dict(
         autoescape=kw.get('autoescape', True),
@@ -27,8 +35,15 @@ def init_jinja2(app, **kw):
         block_end_string=kw.get('block_end_string', '%}'),
         variable_start_string=kw.get('variable_start_string', '{{'),
         variable_end_string=kw.get('variable_end_string', '}}'),
-        auto_reload=kw.get('auto_reload', True)
+        auto_reload=kw.get('auto_reload', True),
+        cache_size=kw.get('cache_size', 400),
+        enable_async=kw.get('enable_async', False)
     )
+    bytecode_cache = kw.get('bytecode_cache', None)
+    if bytecode_cache:
+        os.makedirs(bytecode_cache, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
+        logging.info('set jinja2 bytecode cache: %s.' % bytecode_cache)
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
@@ -38,6 +53,12 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    if kw.get('preload', False):
+        # 启动时编译全部模板, 请求时直接命中模板缓存
+        names = env.list_templates()
+        for name in names:
+            env.get_template(name)
+        logging.info('preload %s jinja2 templates.' % len(names))
     app['__templating__'] = env
 
 
@@ -47,18 +68,45 @@ async def logger_factory(app, handler):
 
     async def logger(request):
         logging.info('Request:%s %s' % (request.method, request.path))
-        return await handler(request)
+        trace, token = tracing.begin(request)
+        if trace is None:
+            return await handler(request)
+        try:
+            resp = await handler(request)
+        finally:
+            tracing.end(trace, token)
+        # 流式响应已经发送了响应头
+        if tracing.server_timing and not resp.prepared:
+            resp.headers['Server-Timing'] = trace.server_timing()
+        return resp
 
     return logger
 
 
+async def loader_factory(app, handler):
+    """
+    每个请求使用独立的批量加载范围, 见Model.load()
+    aiohttp每个请求在独立的Task中处理, 上下文互不影响(与Orm的_last_write, _transaction相同);
+    begin/end只是让加载器在handler返回后即释放, 不等到Task结束
+    """
+
+    async def scoped(request):
+        token = loader.begin()
+        try:
+            return await handler(request)
+        finally:
+            loader.end(token)
+
+    return scoped
+
+
 async def data_factory(app, handler):
     logging.info('start data_factory in app: %s' % app)
 
     async def parse_data(request):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
-                request.__data__ = await request.json()
+                request.__data__ = await request.json(loads=codec.loads)
                 logging.info('request json: %s.' % str(request.__data__))
             elif request.content_type.startswith('application/x-wwww-form-urlencoded'):
                 request.__data__ = await request.post()
@@ -67,6 +115,86 @@ async def data_factory(app, handler):
     return parse_data
 
 
+# 流式响应每次写出的最小字节数, 避免模板的细小片段逐个写socket
+STREAM_CHUNK_SIZE = 8192
+
+
+async def iter_async(items):
+    """
+    普通迭代器转换为异步迭代器
+    :param items:
+    :return:
+    """
+    for item in items:
+        yield item
+
+
+async def iter_json_array(first, items):
+    """
+    逐个编码为JSON数组片段
+    :param first: 第一个元素
+    :param items: 剩余元素的异步迭代器
+    :return:
+    """
+    yield b'[' + codec.dumps(first)
+    async for item in items:
+        yield b',' + codec.dumps(item)
+    yield b']'
+
+
+async def stream_response(request, chunks, content_type):
+    """
+    chunked方式逐块写出响应, 首字节不必等待整个响应生成
+    :param request:
+    :param chunks: str或bytes的异步迭代器
+    :param content_type:
+    :return:
+    """
+    resp = web.StreamResponse()
+    resp.content_type = content_type
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    buffer = []
+    size = 0
+    async for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            await resp.write(b''.join(buffer))
+            buffer = []
+            size = 0
+    if buffer:
+        await resp.write(b''.join(buffer))
+    await resp.write_eof()
+    return resp
+
+
+async def stream_items(request, items):
+    """
+    流式输出异步迭代器: str/bytes按html片段输出, 其余元素按JSON数组输出
+    :param request:
+    :param items: 异步迭代器
+    :return:
+    """
+    items = items.__aiter__()
+    try:
+        first = await items.__anext__()
+    except StopAsyncIteration:
+        resp = web.Response(body=b'[]')
+        resp.content_type = 'application/json; charset=utf-8'
+        return resp
+    if isinstance(first, (str, bytes)):
+        async def chunks():
+            yield first
+            async for item in items:
+                yield item
+        return await stream_response(request, chunks(), 'text/html')
+    return await stream_response(request, iter_json_array(first, items), 'application/json')
+
+
 async def response_factory(app, handler):
     """
       响应统一处理
@@ -82,6 +210,9 @@ async def response_factory(app, handler):
         # 字符串直接返回
         if isinstance(r, web.StreamResponse):
             return r
+        # 异步生成器流式返回
+        if hasattr(r, '__aiter__'):
+            return await stream_items(request, r)
         # 字节流按照流的方式返回
         if isinstance(r, bytes):
             resp = web.Response(body=r)
@@ -99,13 +230,28 @@ async def response_factory(app, handler):
             template = r.get('__template__')
             # 没模板直接返回数据
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False,
-                                                    default=lambda msg: msg.__dict__).encode('utf-8'))
+                with tracing.span(tracing.ENCODE):
+                    body = codec.dumps(r)
+                resp = web.Response(body=body)
                 resp.content_type = 'application/json; charset=utf-8'
                 return resp
             # 有模板将数据放入模板, 返回页面
             else:
-                resp = web.Response(body=app['__template__'].get_template(template).render(**r).encode('utf-8'))
+                env = app['__templating__']
+                # __stream__=True时边渲染边输出, 适用于大页面
+                if r.get('__stream__'):
+                    if env.is_async:
+                        chunks = env.get_template(template).generate_async(**r)
+                    else:
+                        chunks = iter_async(env.get_template(template).generate(**r))
+                    return await stream_response(request, chunks, 'text/html')
+                with tracing.span(tracing.RENDER):
+                    if env.is_async:
+                        body = await env.get_template(template).render_async(**r)
+                    else:
+                        body = env.get_template(template).render(**r)
+                    body = body.encode('utf-8')
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html; charset=utf-8'
                 return resp
         # int类型直接返回
@@ -140,15 +286,67 @@ def datetime_filter(special_time):
     return u'%s年%s月%s日' % (format_datetime.year, format_datetime.month, format_datetime.day)
 
 
+async def close_db(app):
+    await Orm.close_pool()
+
+
+# 最近一次启动的各阶段耗时(秒)
+startup_phases = dict()
+
+
+@metrics.register
+def startup_metrics():
+    lines = ['# TYPE blogs_startup_seconds gauge']
+    for phase, elapsed in startup_phases.items():
+        lines.append('blogs_startup_seconds{phase="%s"} %s' % (phase, elapsed))
+    return lines
+
+
 async def init(init_loop):
-    await Orm.create_pool(
-        init_loop=init_loop, host='127.0.0.1', user='test', password='Aas_12345678', db='awesome')
-    app = web.Application(loop=init_loop, middlewares=[logger_factory, response_factory])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
-    add_routes(app, 'handlers')
-    add_static(app)
-    await web.run_app(app, host='127.0.0.1', port=9000)
+    start = last = time.perf_counter()
+
+    def phase(name):
+        nonlocal last
+        now = time.perf_counter()
+        startup_phases[name] = now - last
+        last = now
+
+    metrics.configure(**to_dict(configs.metrics))
+    page_cache.configure(**to_dict(configs.page_cache))
+    compress.configure(**to_dict(configs.compress))
+    tracing.configure(**to_dict(configs.tracing))
+    # 实体模块可能在首次请求时才导入, 设置在定义实体时生效
+    Orm.configure_caches(**to_dict(configs.entity_cache))
+    await Orm.create_pool(init_loop=init_loop, **to_dict(configs.db))
+    phase('pool')
+    # 页面缓存在压缩之前, 缓存压缩后的响应
+    middlewares = [logger_factory, page_cache.cache_factory, compress.compress_factory, loader_factory,
+                   response_factory]
+    app = web.Application(middlewares=middlewares)
+    init_jinja2(app, filters=dict(datetime=datetime_filter), **to_dict(configs.templates))
+    phase('templates')
+    add_routes(app, 'blogs.handlers', lazy=configs.routes.lazy, manifest_dir=configs.routes.manifest_dir)
+    phase('routes')
+    if configs.db.create_tables:
+        from blogs import entity
+        await Orm.create_tables(entity.Customer, entity.Blog, entity.Comment)
+        phase('tables')
+    add_static(app, precompress=configs.compress.precompress_static)
+    phase('static')
+    app.on_cleanup.append(close_db)
+    startup_phases['total'] = elapsed = time.perf_counter() - start
+    budget = configs.routes.startup_budget
+    detail = ', '.join('%s %.1fms' % (name, value * 1e3) for name, value in startup_phases.items())
+    if budget and elapsed > budget:
+        logging.warning('startup took %.3fs, over budget %.3fs: %s.' % (elapsed, budget, detail))
+    else:
+        logging.info('startup took %.3fs: %s.' % (elapsed, detail))
+    return app
 
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
+if __name__ == '__main__':
+    # 单进程启动, 多进程使用: python -m blogs.server
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # 应用和连接池在该循环上创建, run_app必须运行同一个循环
+    web.run_app(loop.run_until_complete(init(loop)), host=configs.server.host, port=configs.server.port, loop=loop)
@@ -0,0 +1,240 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  数据库后端: Orm通过后端创建连接池和游标, 连接池/连接/游标的接口与aiomysql一致
+    mysql   aiomysql, 生产环境
+    sqlite  标准库sqlite3, 默认内存数据库, 用于本地和CI中的基准测试, 不需要MySQL
+  配置db.backend选择后端
+"""
+import asyncio
+import functools
+import logging
+import re
+import sqlite3
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+__author__ = 'boris han'
+
+# 游标类型, 由后端映射为具体的游标类
+DICT = 'dict'
+TUPLE = 'tuple'
+STREAM = 'stream'
+
+
+class MySQLBackend(object):
+
+    name = 'mysql'
+
+    def __init__(self):
+        if aiomysql is None:
+            raise ImportError('mysql backend requires aiomysql')
+        self.cursors = {DICT: aiomysql.DictCursor, TUPLE: aiomysql.Cursor, STREAM: aiomysql.SSCursor}
+
+    async def create_pool(self, init_loop, **kw):
+        return await aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw.get('user', kw.get('username')),
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            # 连接存活超过该秒数后关闭重建, -1表示不回收
+            pool_recycle=kw.get('pool_recycle', -1),
+            loop=init_loop
+        )
+
+
+_PLACEHOLDER = re.compile(r'%([s%])')
+
+
+@functools.lru_cache(maxsize=512)
+def to_qmark(sql):
+    """
+    Orm传入的SQL使用%s占位符, 转换为sqlite3的?占位符
+    """
+    return _PLACEHOLDER.sub(lambda m: '?' if m.group(1) == 's' else '%', sql)
+
+
+class SQLiteCursor(object):
+    """
+      sqlite3游标的异步包装, 返回tuple行
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = conn.pool.db.cursor()
+        self.rowcount = -1
+
+    def _rows(self, rows):
+        return rows
+
+    async def execute(self, sql, args=()):
+        await self._conn.wait_turn()
+        self._cursor.execute(to_qmark(sql), tuple(args or ()))
+        self.rowcount = self._cursor.rowcount
+        return self.rowcount
+
+    async def executemany(self, sql, seq_of_args):
+        await self._conn.wait_turn()
+        self._cursor.executemany(to_qmark(sql), [tuple(args) for args in seq_of_args])
+        self.rowcount = self._cursor.rowcount
+        return self.rowcount
+
+    async def fetchone(self):
+        row = self._cursor.fetchone()
+        return None if row is None else self._rows([row])[0]
+
+    async def fetchmany(self, size):
+        return self._rows(self._cursor.fetchmany(size))
+
+    async def fetchall(self):
+        return self._rows(self._cursor.fetchall())
+
+    async def close(self):
+        self._cursor.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+class SQLiteDictCursor(SQLiteCursor):
+
+    def _rows(self, rows):
+        names = [d[0] for d in self._cursor.description]
+        return [dict(zip(names, row)) for row in rows]
+
+
+class SQLiteConnection(object):
+    """
+      逻辑连接: 同一连接池的连接共用一个sqlite3连接
+      begin()取得连接池的事务锁, 其他连接的SQL等待事务结束后执行, 不会混入未提交的事务
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._in_transaction = False
+
+    def cursor(self, cursor_class=SQLiteCursor):
+        return cursor_class(self)
+
+    async def wait_turn(self):
+        lock = self.pool.lock
+        if not self._in_transaction and lock.locked():
+            async with lock:
+                pass
+
+    async def begin(self):
+        await self.pool.lock.acquire()
+        self._in_transaction = True
+        self.pool.db.execute('begin')
+
+    async def _end(self, sql):
+        if not self._in_transaction:
+            return
+        try:
+            self.pool.db.execute(sql)
+        finally:
+            self._in_transaction = False
+            self.pool.lock.release()
+
+    async def commit(self):
+        await self._end('commit')
+
+    async def rollback(self):
+        await self._end('rollback')
+
+
+class SQLitePool(object):
+    """
+      连接池接口与aiomysql.Pool一致, maxsize限制同时借出的逻辑连接数
+      sqlite3在事件循环线程中同步执行, 适用于内存数据库和小数据量的基准测试
+    """
+
+    def __init__(self, database=':memory:', minsize=1, maxsize=10):
+        self.db = sqlite3.connect(database, isolation_level=None, check_same_thread=False)
+        self.lock = asyncio.Lock()
+        self._minsize = minsize
+        self.maxsize = maxsize
+        self._free = [SQLiteConnection(self) for _ in range(minsize)]
+        self._used = set()
+        self._semaphore = asyncio.Semaphore(maxsize)
+        self._closed = False
+
+    @property
+    def minsize(self):
+        return self._minsize
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError('Cannot acquire connection after closing pool')
+        await self._semaphore.acquire()
+        conn = self._free.pop() if self._free else SQLiteConnection(self)
+        self._used.add(conn)
+        return conn
+
+    def release(self, conn):
+        if conn not in self._used:
+            return
+        if conn._in_transaction:
+            # 未结束的事务回滚, 释放事务锁
+            logging.warning('release connection in transaction, rollback.')
+            self.db.execute('rollback')
+            conn._in_transaction = False
+            self.lock.release()
+        self._used.discard(conn)
+        if len(self._free) < self._minsize:
+            self._free.append(conn)
+        self._semaphore.release()
+
+    def close(self):
+        self._closed = True
+
+    async def wait_closed(self):
+        self.db.close()
+
+
+class SQLiteBackend(object):
+
+    name = 'sqlite'
+    cursors = {DICT: SQLiteDictCursor, TUPLE: SQLiteCursor, STREAM: SQLiteCursor}
+
+    async def create_pool(self, init_loop, **kw):
+        """
+        :param kw: database为数据库文件, 默认内存数据库; minsize, maxsize; 其余MySQL参数忽略
+        """
+        return SQLitePool(kw.get('database', ':memory:'), kw.get('minsize', 1), kw.get('maxsize', 10))
+
+
+BACKENDS = {
+    MySQLBackend.name: MySQLBackend,
+    SQLiteBackend.name: SQLiteBackend,
+}
+
+
+def get_backend(name):
+    """
+    :param name: mysql/sqlite
+    :return: 后端实例
+    """
+    if name not in BACKENDS:
+        raise ValueError('Unknown database backend %s' % name)
+    return BACKENDS[name]()
@@ -0,0 +1,110 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  进程内缓存: 按条目数LRU淘汰, 按TTL过期
+"""
+import time
+from collections import OrderedDict
+
+__author__ = 'boris han'
+
+
+class LRUCache(object):
+    """
+      LRU缓存, maxsize限制条目数, ttl(秒)为None时不过期, 为0时立即过期
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key => (过期时间, value)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        获取缓存, 过期的条目视为不存在
+        :param key:
+        :param default: 不存在时的返回值
+        :return:
+        """
+        item = self._data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires is None or expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        """
+        写入缓存, 超出maxsize时淘汰最久未使用的条目
+        :param key:
+        :param value:
+        :param ttl: 单条过期时间, 默认使用缓存的ttl
+        :return:
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, hit_rate=self.hits / total if total else 0.0)
+
+
+class EntityCache(object):
+    """
+      实体缓存: 主键 => 实体, 查询条件 => 实体list
+      任意写操作都会使全部查询结果失效, 多进程部署时各进程的缓存最多滞后ttl秒
+      generation在每次失效时加1: 读取前记录, 查询返回后已变化说明期间有写操作, 结果可能是旧数据, 不写入缓存
+    """
+
+    def __init__(self, maxsize=1000, ttl=60):
+        self.rows = LRUCache(maxsize, ttl)
+        self.queries = LRUCache(maxsize, ttl)
+        self.generation = 0
+
+    def invalidate(self, *keys):
+        """
+        写操作后失效指定主键和全部查询结果
+        :param keys: 主键
+        :return:
+        """
+        self.generation += 1
+        for key in keys:
+            self.rows.pop(key)
+        self.queries.clear()
+
+    def clear(self):
+        self.generation += 1
+        self.rows.clear()
+        self.queries.clear()
+
+    def stats(self):
+        rows = self.rows.stats()
+        queries = self.queries.stats()
+        hits = rows['hits'] + queries['hits']
+        total = hits + rows['misses'] + queries['misses']
+        return dict(rows=rows, queries=queries, hit_rate=hits / total if total else 0.0)
@@ -0,0 +1,110 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  JSON编解码, 按orjson > ujson > json的顺序使用已安装的实现
+  Model继承dict, 各实现都直接按dict编码, 不再经过default转换
+"""
+import decimal
+import json
+import logging
+
+__author__ = 'boris han'
+
+
+def default(obj):
+    """
+    非内置类型的编码方式
+    :param obj:
+    :return:
+    """
+    # MySQL的sum/avg等聚合结果为Decimal
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    # Model.__row__行对象
+    if hasattr(obj, '_asdict'):
+        return obj._asdict()
+    if hasattr(obj, '__dict__'):
+        return obj.__dict__
+    raise TypeError('Object of type %s is not JSON serializable' % obj.__class__.__name__)
+
+
+def _json_backend():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+
+    def dumps(obj):
+        return encoder.encode(obj).encode('utf-8')
+
+    return dumps, json.loads
+
+
+def _orjson_backend():
+    import orjson
+
+    # 与json一致, 允许int等非str的dict键
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=default, option=option)
+
+    return dumps, orjson.loads
+
+
+def _ujson_backend():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+    return dumps, ujson.loads
+
+
+# 按优先级排列
+BACKENDS = (
+    ('orjson', _orjson_backend),
+    ('ujson', _ujson_backend),
+    ('json', _json_backend),
+)
+
+
+def available_backends():
+    """
+    已安装的实现
+    :return: [(名称, dumps, loads)]
+    """
+    result = []
+    for name, factory in BACKENDS:
+        try:
+            result.append((name,) + factory())
+        except ImportError:
+            continue
+    return result
+
+
+def use(name=None):
+    """
+    切换JSON实现
+    :param name: orjson/ujson/json, None表示使用已安装的最快实现
+    :return: 实际使用的实现名称
+    """
+    global backend, dumps, loads
+    for backend_name, factory in BACKENDS:
+        if name is not None and backend_name != name:
+            continue
+        try:
+            dumps, loads = factory()
+        except ImportError:
+            if name is not None:
+                raise
+            continue
+        backend = backend_name
+        logging.info('json backend: %s.' % backend)
+        return backend
+    raise ValueError('Unknown json backend %s' % name)
+
+
+backend = None
+# dumps(obj) -> bytes, loads(str|bytes) -> obj
+dumps = None
+loads = None
+use()
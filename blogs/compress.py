@@ -0,0 +1,213 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  响应压缩:
+    静态资源启动时预压缩为.gz/.br, 由static_handler按Accept-Encoding(忽略q=0)选择并以sendfile发送
+    动态响应由compress_factory中间件压缩, 超过executor_threshold的响应体在线程池中压缩, 不阻塞事件循环
+  安装brotli后支持br, 否则只使用gzip
+"""
+import asyncio
+import gzip
+import logging
+import os
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__author__ = 'boris han'
+
+# 是否压缩动态响应
+enabled = True
+# gzip压缩级别1-9
+level = 6
+# brotli压缩级别0-11, 动态响应使用较低级别
+brotli_quality = 4
+# 小于该字节数的响应不压缩
+threshold = 1024
+# 不小于该字节数的响应在线程池中压缩
+executor_threshold = 64 * 1024
+# 压缩的Content-Type
+types = ('text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript',
+         'application/xml', 'image/svg+xml')
+# 启动时预压缩的静态文件扩展名
+static_extensions = ('.html', '.css', '.js', '.json', '.svg', '.txt', '.xml', '.map')
+
+# 编码 => 预压缩文件后缀, 按优先级排列
+_SUFFIXES = (('br', '.br'), ('gzip', '.gz'))
+
+
+def configure(**kw):
+    """
+    修改配置, 参数见config_default的compress部分
+    :param kw: enabled, level, brotli_quality, threshold, executor_threshold, types, static_extensions
+    :return:
+    """
+    global enabled, level, brotli_quality, threshold, executor_threshold, types, static_extensions
+    enabled = kw.get('enabled', enabled)
+    level = kw.get('level', level)
+    brotli_quality = kw.get('brotli_quality', brotli_quality)
+    threshold = kw.get('threshold', threshold)
+    executor_threshold = kw.get('executor_threshold', executor_threshold)
+    types = tuple(kw.get('types', types))
+    static_extensions = tuple(kw.get('static_extensions', static_extensions))
+
+
+def accepted_encodings(request):
+    """
+    客户端接受的编码, 忽略q=0
+    :param request:
+    :return: set
+    """
+    result = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        q = [p.strip() for p in parts[1:] if p.strip().startswith('q=')]
+        if q and q[0][2:] in ('0', '0.0', '0.00', '0.000'):
+            continue
+        result.add(name)
+    return result
+
+
+def choose_encoding(request):
+    """
+    :return: br/gzip, 客户端不接受压缩时返回None
+    """
+    accepted = accepted_encodings(request)
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding, quality=None):
+    """
+    :param body: bytes
+    :param encoding: br/gzip
+    :param quality: 压缩级别, 默认使用配置
+    :return: bytes
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality if quality is None else quality)
+    # mtime=0: 相同的响应体压缩结果相同, ETag不随时间变化
+    return gzip.compress(body, compresslevel=level if quality is None else quality, mtime=0)
+
+
+def precompress(root):
+    """
+    预压缩root目录下的静态文件, 压缩文件比源文件新时跳过, 压缩后没有变小的不保留
+    :param root: 静态文件目录
+    :return: 生成的压缩文件数量
+    """
+    count = 0
+    for path, dirs, files in os.walk(root):
+        for name in files:
+            if not name.endswith(static_extensions):
+                continue
+            source = os.path.join(path, name)
+            stat = os.stat(source)
+            if stat.st_size < threshold:
+                continue
+            data = None
+            for encoding, suffix in _SUFFIXES:
+                if encoding == 'br' and brotli is None:
+                    continue
+                target = source + suffix
+                if os.path.exists(target) and os.stat(target).st_mtime >= stat.st_mtime:
+                    continue
+                if data is None:
+                    with open(source, 'rb') as f:
+                        data = f.read()
+                compressed = compress(data, encoding, 11 if encoding == 'br' else 9)
+                if len(compressed) >= len(data):
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(compressed)
+                count += 1
+    logging.info('precompressed %s static files in %s.' % (count, root))
+    return count
+
+
+class StaticFileResponse(web.FileResponse):
+    """
+      FileResponse按Accept-Encoding子串选择.gz/.br, gzip;q=0时也会发送.gz;
+      发送前把Accept-Encoding改写为accepted_encodings()的结果
+    """
+
+    async def prepare(self, request):
+        headers = request.headers.copy()
+        headers['Accept-Encoding'] = ', '.join(sorted(accepted_encodings(request)))
+        return await super().prepare(request.clone(headers=headers))
+
+
+def static_handler(root):
+    """
+    静态文件handler, 存在客户端接受的预压缩文件时发送压缩文件
+    :param root: 静态文件目录
+    :return:
+    """
+    root = os.path.realpath(root)
+
+    async def static(request):
+        path = os.path.realpath(os.path.join(root, request.match_info['filename']))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return StaticFileResponse(path)
+
+    return static
+
+
+def add_vary(resp, header):
+    """
+    追加Vary请求头, 保留已有的值
+    """
+    value = resp.headers.get('Vary')
+    if not value:
+        resp.headers['Vary'] = header
+    elif value.strip() != '*' and header.lower() not in (v.strip().lower() for v in value.split(',')):
+        resp.headers['Vary'] = '%s, %s' % (value, header)
+
+
+def compressible(resp):
+    if not isinstance(resp, web.Response) or not isinstance(resp.body, bytes):
+        return False
+    if resp.status != 200 or 'Content-Encoding' in resp.headers or len(resp.body) < threshold:
+        return False
+    return (resp.content_type or '').startswith(types)
+
+
+async def compress_factory(app, handler):
+    """
+      动态响应压缩中间件, 放在page_cache之后, 缓存的是压缩后的响应
+    :param app:
+    :param handler:
+    :return:
+    """
+
+    async def compressed(request):
+        resp = await handler(request)
+        if not enabled or not compressible(resp):
+            return resp
+        # 不压缩时响应同样随Accept-Encoding变化
+        add_vary(resp, 'Accept-Encoding')
+        encoding = choose_encoding(request)
+        if encoding is None:
+            return resp
+        body = resp.body
+        if len(body) >= executor_threshold:
+            body = await asyncio.get_event_loop().run_in_executor(None, compress, body, encoding)
+        else:
+            body = compress(body, encoding)
+        resp.body = body
+        resp.headers['Content-Encoding'] = encoding
+        return resp
+
+    return compressed
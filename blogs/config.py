@@ -3,69 +3,207 @@
 
 """
   获取配置
+  config_default合并config_override和环境变量后冻结为只读的属性访问树, 首次访问configs时加载一次:
+    from blogs.config import configs
+    configs.db.host
+  环境变量覆盖: AWESOME_<节>__<键>, 值按默认配置中同名项的类型转换(字符串保持字符串),
+  默认值为None, list, dict或没有默认值时按JSON解析, 解析失败时作为字符串, 如
+    AWESOME_DB__HOST=10.0.0.1 AWESOME_DB__MAXSIZE=50 AWESOME_TEMPLATES__AUTO_RELOAD=false
+  键不是合法标识符(如blog-posts)或与ConfigNode方法同名(如items)时只能按configs.section['key']访问
 """
+import importlib
+import json
+import keyword
 import logging
-
-from blogs import config_default, config_override
+import os
+import types
 
 __author__ = 'boris han'
 
+# 环境变量前缀, 层级之间用双下划线分隔
+ENV_PREFIX = 'AWESOME_'
+ENV_SEPARATOR = '__'
+
 
-class Dict(dict):
+class ConfigNode(object):
     """
-      自定义字典类
+      只读配置节点, 全部键值保存在_values中;
+      每个节点的类按可作为属性名的键生成__slots__, 属性访问不经过__getattr__
     """
-    def __init__(self, names=(), values=(), **kw):
-        super(Dict, self).__init__(**kw)
-        for k, v in zip(names, values):
-            self[k] = v
 
+    __slots__ = ('_values',)
 
-    def __getattr__(self, item):
-        try:
-            return self[item]
-        except KeyError:
-            raise AttributeError(r"'Dict' has no attribute '%s'" % item)
+    def __setattr__(self, key, value):
+        raise AttributeError('config is read-only: %s' % key)
 
+    def __delattr__(self, key):
+        raise AttributeError('config is read-only: %s' % key)
 
-    def __setattr__(self, key, value):
-        self[key] = value
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def keys(self):
+        return self._values.keys()
+
+    def items(self):
+        return self._values.items()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % item for item in self.items()))
 
 
 def merge(defaults, override):
     """
-      合并两个配置文件的配置
+      合并两个配置文件的配置, override中新增的键也保留
     :param defaults:
     :param override:
     :return:
     """
-    result = {}
-    for k, v in defaults.items():
-        if k in override:
-            if isinstance(v, dict):
-                result[k] = merge(v, override[k])
-            else:
-                result[k] = override[k]
+    result = dict(defaults)
+    for k, v in override.items():
+        if isinstance(v, dict) and isinstance(defaults.get(k), dict):
+            result[k] = merge(defaults[k], v)
         else:
             result[k] = v
     return result
 
 
-def to_dict(target):
+_TRUE = ('1', 'true', 'yes', 'on')
+_FALSE = ('0', 'false', 'no', 'off')
+
+
+def parse_env_value(value, default=None):
     """
-      字典数据转换
-    :param target:
+      环境变量的值转换为默认值的类型, 如密码123456仍是字符串
+    :param value: 环境变量的值
+    :param default: 默认配置中的值
     :return:
     """
-    defined_dict = Dict()
-    for k, v in target.items():
-        defined_dict[k] = to_dict(v) if isinstance(v, dict) else v
-    return defined_dict
+    if isinstance(default, str):
+        return value
+    if isinstance(default, bool):
+        if value.lower() in _TRUE:
+            return True
+        if value.lower() in _FALSE:
+            return False
+        raise ValueError('Invalid boolean config value %s' % value)
+    if isinstance(default, (int, float)):
+        return type(default)(value)
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def lookup(configs, path):
+    """
+      按路径取配置值, 不存在时返回None
+    """
+    for part in path:
+        if not isinstance(configs, dict):
+            return None
+        configs = configs.get(part)
+    return configs
 
 
-configs = config_default.configs
+def env_overrides(environ=None, defaults=None):
+    """
+      从环境变量读取覆盖的配置
+    :param environ: 默认os.environ
+    :param defaults: 合并后的配置, 按其中同名项的类型转换环境变量的值
+    :return: 嵌套dict
+    """
+    result = {}
+    for name, value in (os.environ if environ is None else environ).items():
+        if not name.startswith(ENV_PREFIX):
+            continue
+        path = [part.lower() for part in name[len(ENV_PREFIX):].split(ENV_SEPARATOR)]
+        if not all(path):
+            continue
+        node = result
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        try:
+            node[path[-1]] = parse_env_value(value, lookup(defaults or {}, path))
+        except ValueError:
+            raise ValueError('Invalid value for %s: %s' % (name, value))
+    return result
+
+
+def attribute_name(key):
+    """
+      键能否作为属性访问: 合法标识符, 不是关键字, 不与ConfigNode的方法同名
+    """
+    return isinstance(key, str) and key.isidentifier() and not keyword.iskeyword(key) \
+        and not key.startswith('_') and not hasattr(ConfigNode, key)
+
+
+def freeze(value, name='configs'):
+    """
+      dict转换为ConfigNode, list转换为tuple
+    :param value:
+    :param name: 节点名称, 用作生成的类名
+    :return:
+    """
+    if isinstance(value, dict):
+        values = {k: freeze(v, k) for k, v in value.items()}
+        slots = tuple(k for k in values if attribute_name(k))
+        cls = type('Config_%s' % name, (ConfigNode,), {'__slots__': slots})
+        node = cls.__new__(cls)
+        object.__setattr__(node, '_values', types.MappingProxyType(values))
+        for k in slots:
+            object.__setattr__(node, k, values[k])
+        return node
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item, name) for item in value)
+    return value
+
+
+def to_dict(target):
+    """
+      配置节点转换为普通dict, 用于**展开为函数参数
+    :param target: ConfigNode, 为None时返回空dict
+    :return:
+    """
+    if target is None:
+        return {}
+    if isinstance(target, ConfigNode):
+        return {k: to_dict(v) for k, v in target.items()}
+    if isinstance(target, tuple):
+        return [to_dict(item) for item in target]
+    return target
+
 
-try:
-    configs = merge(configs, config_override.configs)
-except ImportError as e:
-    logging.error('导入配置文件异常', e)
+def load():
+    """
+      合并config_default, config_override(可选)和环境变量
+    :return: ConfigNode
+    """
+    from blogs import config_default
+    result = config_default.configs
+    try:
+        result = merge(result, importlib.import_module('blogs.config_override').configs)
+    except ImportError:
+        logging.info('no config_override, use default configs.')
+    result = merge(result, env_overrides(defaults=result))
+    return freeze(result)
+
+
+def __getattr__(name):
+    # 首次访问configs时才加载
+    if name == 'configs':
+        value = globals()['configs'] = load()
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
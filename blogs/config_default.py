@@ -11,10 +11,118 @@ __author__ = 'boris han'
 configs={
     'debug': True,
     'db': {
+        # 数据库后端: mysql | sqlite(标准库sqlite3, database为数据库文件, 默认内存数据库)
+        'backend': 'mysql',
+        # 启动时创建不存在的表
+        'create_tables': False,
         'host': '127.0.0.1',
         'port': 3306,
         'username': 'test',
         'password': 'Aas_12345678',
-        'db': 'awesome'
+        'db': 'awesome',
+        'minsize': 1,
+        'maxsize': 10,
+        # 连接存活超过该秒数后重建, -1表示不回收
+        'pool_recycle': 3600,
+        # 启动时预先建立minsize个连接
+        'warm': True,
+        # 按平均等待时间在minsize和maxsize之间调整常驻连接数
+        'adaptive': False,
+        # 平均等待超过该秒数时增加常驻连接
+        'adaptive_wait': 0.005,
+        # 每多少次获取连接调整一次
+        'adaptive_window': 100,
+        'adaptive_step': 1,
+        # 只读从库, 每项为覆盖以上主库参数的dict, 如[{'host': '10.0.0.2'}]
+        'replicas': [],
+        # 从库选择策略: round_robin | least_conn
+        'read_strategy': 'round_robin',
+        # 写操作后该秒数内, 同一请求的读操作仍走主库
+        'read_your_writes': 1.0
+    },
+    'templates': {
+        # 开发环境检查模板修改, 生产环境关闭
+        'auto_reload': True,
+        # 模板字节码缓存目录, None表示不缓存
+        'bytecode_cache': None,
+        # 启动时编译全部模板
+        'preload': False,
+        # 使用render_async渲染
+        'enable_async': False
+    },
+    'metrics': {
+        # 记录SQL耗时等指标, 通过/metrics导出
+        'enabled': True,
+        # 慢查询阈值(秒), 超过时连同参数输出WARNING日志, None表示不记录
+        'slow_query': 0.5,
+        # 分别统计的SQL语句数上限, 超出的语句合并为statement="other"
+        'max_statements': 500
+    },
+    'page_cache': {
+        'enabled': True,
+        # 没有声明@get(path, cache=...)的页面是否缓存
+        'default': False,
+        'maxsize': 1000,
+        # 默认过期秒数
+        'ttl': 10,
+        # 参与缓存key的请求头
+        'vary': ['Accept', 'Accept-Encoding', 'Accept-Language'],
+        # 为所有GET响应生成ETag, 支持If-None-Match返回304
+        'etag': True,
+        # 写请求成功后清空页面缓存
+        'purge_on_write': True
+    },
+    'entity_cache': {
+        # 表名 => 实体缓存设置, 覆盖Model的__cache__, maxsize为0时关闭
+        'customers': {
+            'maxsize': 1000,
+            'ttl': 60
+        }
+    },
+    'tracing': {
+        # 按span统计请求耗时, 见tracing
+        'enabled': True,
+        # 抽样比例0-1, 开发环境可设为1.0
+        'sample_rate': 0.01,
+        # 抽中的请求返回Server-Timing响应头
+        'server_timing': True
+    },
+    'compress': {
+        # 压缩动态响应
+        'enabled': True,
+        # gzip压缩级别1-9
+        'level': 6,
+        # brotli压缩级别0-11, 需要安装brotli
+        'brotli_quality': 4,
+        # 小于该字节数的响应不压缩
+        'threshold': 1024,
+        # 不小于该字节数的响应在线程池中压缩
+        'executor_threshold': 65536,
+        # 启动时预压缩静态文件为.gz/.br
+        'precompress_static': True
+    },
+    'routes': {
+        # 按路由清单注册, handler模块在首次请求时才导入
+        'lazy': True,
+        # 路由清单目录, None表示handler模块所在目录的__pycache__, 目录需只有运行服务的用户可写
+        'manifest_dir': None,
+        # 启动耗时预算(秒), 超出时输出WARNING日志, None表示不检查
+        'startup_budget': 1.0
+    },
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        # worker进程数, 0表示CPU核数
+        'workers': 0,
+        # True: 每个worker以SO_REUSEPORT各自监听; False: 共享父进程绑定的socket
+        'reuse_port': True,
+        # worker心跳超时秒数, 超时视为事件循环阻塞, 杀掉重启
+        'timeout': 30,
+        # 优雅退出等待秒数
+        'graceful_timeout': 30,
+        # 监听队列长度
+        'backlog': 1024,
+        # keep-alive连接空闲超时秒数
+        'keepalive_timeout': 75
     }
 }
@@ -23,9 +23,11 @@ class Customer(Model):
     用户
     """
     __table__ = 'customers'
+    # 开启实体缓存
+    __cache__ = dict(maxsize=1000, ttl=60)
 
     # 主键
-    id = StringField(is_primary=True, default=next_id(), ddl='varchar(50)')
+    id = StringField(is_primary=True, default=next_id, ddl='varchar(50)')
     # 邮件地址
     email = StringField(ddl='varchar(50)')
     # 登录密码
@@ -47,7 +49,7 @@ class Blog(Model):
     __table__ = 'blog'
 
     # 主键
-    id = StringField(is_primary=True, default=next_id(), ddl='varchar(50)')
+    id = StringField(is_primary=True, default=next_id, ddl='varchar(50)')
     # 客户id
     customer_id = StringField(ddl='varchar(50)')
     # 客户名称
@@ -71,7 +73,7 @@ class Comment(Model):
     __table__ = 'comment'
 
     # 主键
-    id = StringField(is_primary=True, default=next_id(), ddl='varchar(50)')
+    id = StringField(is_primary=True, default=next_id, ddl='varchar(50)')
     # 博客id
     blog_id = StringField(ddl='varchar(50)')
     # 客户id
@@ -4,16 +4,25 @@
 """
   url 请求控制器
 """
+from aiohttp import web
+
+from blogs import metrics
 from blogs.CoroutineWeb import get
 from blogs.entity import Customer
 
 __author__ = 'boris han'
 
 
-@get('/')
+@get('/', cache=True, coalesce=True)
 async def index(request):
     user = await Customer.find_all()
     return {
-        '__template': 'test.html',
+        '__template__': 'test.html',
         'users': user
     }
+
+
+@get('/metrics', cache=False)
+async def prometheus_metrics():
+    return web.Response(body=metrics.render_prometheus().encode('utf-8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
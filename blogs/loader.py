@@ -0,0 +1,101 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  批量加载: 同一轮事件循环内的load(key)合并为一次查询, 同一请求内相同key只查询一次
+    customers = await asyncio.gather(*[Customer.load(c.customer_id) for c in comments])
+  不在begin()/end()范围内时(后台任务, 脚本)仍合并同一轮的查询, 但查询完成后不保留结果
+"""
+import asyncio
+import contextvars
+
+__author__ = 'boris han'
+
+# 当前请求的加载器, (名称 => BatchLoader)
+_loaders = contextvars.ContextVar('loaders', default=None)
+# 加载范围之外使用的加载器, 不缓存结果, (名称 => BatchLoader)
+_uncached = dict()
+
+
+class BatchLoader(object):
+    """
+      batch_fn(keys)返回{key: value}, 没有返回的key结果为None
+      cache=False时只合并查询中的相同key, 查询完成后即丢弃结果
+    """
+
+    def __init__(self, batch_fn, cache=True):
+        self._batch_fn = batch_fn
+        self._cache = cache
+        # key => future, 同一请求内去重
+        self._futures = dict()
+        self._queue = []
+
+    def load(self, key):
+        """
+        :param key:
+        :return: future, await后得到结果
+        """
+        future = self._futures.get(key)
+        if future is not None:
+            return future
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._futures[key] = future
+        self._queue.append(key)
+        if len(self._queue) == 1:
+            # 本轮事件循环中其他协程的load()都加入队列后再查询
+            loop.call_soon(self._dispatch)
+        return future
+
+    def _dispatch(self):
+        keys, self._queue = self._queue, []
+        asyncio.ensure_future(self._run(keys))
+
+    async def _run(self, keys):
+        try:
+            values = await self._batch_fn(keys)
+        except Exception as e:
+            for key in keys:
+                # 失败的key不缓存, 之后可以重新加载
+                future = self._futures.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key in keys:
+            future = self._futures[key] if self._cache else self._futures.pop(key)
+            if not future.done():
+                future.set_result(values.get(key))
+
+    def clear(self):
+        self._futures.clear()
+
+
+def begin():
+    """
+    开始新的加载范围, 每个请求调用一次
+    :return: token, 传给end()
+    """
+    return _loaders.set(dict())
+
+
+def end(token):
+    _loaders.reset(token)
+
+
+def get_loader(name, batch_fn):
+    """
+    当前请求中名称为name的加载器, 不存在时创建; 不在加载范围内时返回不缓存结果的加载器
+    :param name: 加载器名称, 如(Customer, 'id')
+    :param batch_fn: 批量查询函数
+    :return: BatchLoader
+    """
+    loaders = _loaders.get()
+    if loaders is None:
+        loader = _uncached.get(name)
+        if loader is None:
+            loader = _uncached[name] = BatchLoader(batch_fn, cache=False)
+        return loader
+    loader = loaders.get(name)
+    if loader is None:
+        loader = loaders[name] = BatchLoader(batch_fn)
+    return loader
@@ -0,0 +1,162 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  运行指标: SQL耗时直方图, 返回/影响行数, 慢查询日志
+  render_prometheus()按Prometheus文本格式导出, 其他模块可通过register()追加指标
+"""
+import bisect
+import functools
+import logging
+import re
+
+__author__ = 'boris han'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 直方图分桶上限(秒)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # 最后一个为+Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels=''):
+        """
+        Prometheus直方图样本行
+        :param name: 指标名
+        :param labels: 已格式化的标签, 如 statement="..."
+        :return:
+        """
+        prefix = labels + ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%sle="%s"} %s' % (name, prefix, bound, cumulative))
+        lines.append('%s_bucket{%sle="+Inf"} %s' % (name, prefix, self.count))
+        suffix = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s' % (name, suffix, self.sum))
+        lines.append('%s_count%s %s' % (name, suffix, self.count))
+        return lines
+
+
+class QueryStats(object):
+
+    __slots__ = ('latency', 'rows')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+
+
+# 是否记录指标
+enabled = True
+# 慢查询阈值(秒), None表示不记录慢查询
+slow_query_threshold = None
+# 分别统计的SQL语句数上限, 之后新出现的语句(如where中拼接了字面量)合并到OTHER
+max_statements = 500
+OTHER = 'other'
+# 归一化SQL => QueryStats
+queries = dict()
+# 其他模块注册的指标, 无参函数, 返回样本行list
+collectors = []
+
+_IN_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)+\s*\)')
+
+
+def configure(**kw):
+    """
+    修改配置, 参数见config_default的metrics部分
+    :param kw: enabled, slow_query, max_statements
+    :return:
+    """
+    global enabled, slow_query_threshold, max_statements
+    enabled = kw.get('enabled', enabled)
+    slow_query_threshold = kw.get('slow_query', slow_query_threshold)
+    max_statements = kw.get('max_statements', max_statements)
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    """
+    归一化SQL: 长度不同的in (...)参数列表合并为同一条语句
+    :param sql:
+    :return:
+    """
+    return _IN_LIST.sub('(%s, ...)', ' '.join(sql.split()))
+
+
+def observe_query(sql, args, elapsed, rows, wait):
+    """
+    记录一次SQL执行
+    :param sql: 执行的SQL
+    :param args: 参数, 仅慢查询日志使用
+    :param elapsed: 执行耗时(秒), 不含等待连接的时间
+    :param rows: 返回或影响的行数
+    :param wait: 等待连接池的时间(秒), 仅慢查询日志使用, 连接池自身统计等待时间
+    :return:
+    """
+    if not enabled:
+        return
+    key = normalize(sql)
+    stats = queries.get(key)
+    if stats is None:
+        # 限制内存和/metrics的标签基数
+        if len(queries) >= max_statements:
+            key = OTHER
+            stats = queries.get(key)
+        if stats is None:
+            stats = queries[key] = QueryStats()
+    stats.latency.observe(elapsed)
+    stats.rows += rows
+    if slow_query_threshold is not None and elapsed >= slow_query_threshold:
+        logging.warning('slow query %.3fs (pool wait %.3fs): %s, args: %s', elapsed, wait, sql, args)
+
+
+def register(collector):
+    """
+    注册指标
+    :param collector: 无参函数, 返回Prometheus样本行list(含HELP/TYPE行)
+    :return:
+    """
+    collectors.append(collector)
+    return collector
+
+
+def escape(value):
+    """
+    标签值转义
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    """
+    Prometheus文本格式
+    :return: str
+    """
+    lines = ['# HELP blogs_sql_duration_seconds SQL execution latency.',
+             '# TYPE blogs_sql_duration_seconds histogram']
+    for sql, stats in queries.items():
+        lines.extend(stats.latency.samples('blogs_sql_duration_seconds', 'statement="%s"' % escape(sql)))
+    lines.append('# HELP blogs_sql_rows_total Rows returned or affected.')
+    lines.append('# TYPE blogs_sql_rows_total counter')
+    for sql, stats in queries.items():
+        lines.append('blogs_sql_rows_total{statement="%s"} %s' % (escape(sql), stats.rows))
+    for collector in collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
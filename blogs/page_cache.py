@@ -0,0 +1,176 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  页面缓存: 缓存GET请求的完整响应, key为path+query+vary请求头, 按条目数LRU淘汰, 按TTL过期
+  响应带强ETag, If-None-Match匹配时返回304; 命中缓存时不执行handler
+  handler通过@get(path, cache=...)开启或关闭:
+    cache=None  使用配置的default
+    cache=False 不缓存
+    cache=True  使用配置的ttl
+    cache=秒数  指定ttl, 0表示不缓存
+    cache=dict(ttl=60, vary=('Cookie',)) 指定ttl和额外的vary请求头
+"""
+import hashlib
+import logging
+
+from aiohttp import web
+
+from blogs import metrics
+from blogs.cache import LRUCache
+
+__author__ = 'boris han'
+
+# 是否开启页面缓存
+enabled = True
+# 没有声明cache的handler是否缓存
+default = False
+# 默认过期秒数
+ttl = 10
+# 参与缓存key的请求头
+vary = ('Accept', 'Accept-Encoding', 'Accept-Language')
+# 是否为所有GET响应生成ETag, 不缓存的页面也可以返回304
+etag = True
+# POST等写请求成功后清空页面缓存
+purge_on_write = True
+pages = LRUCache(maxsize=1000, ttl=ttl)
+
+# 不缓存的响应头, Content-Length由Response重新计算
+_SKIP_HEADERS = frozenset(('Content-Length', 'Date', 'Transfer-Encoding', 'Connection'))
+
+
+def configure(**kw):
+    """
+    修改配置, 参数见config_default的page_cache部分
+    :param kw: enabled, default, maxsize, ttl, vary, etag, purge_on_write
+    :return:
+    """
+    global enabled, default, ttl, vary, etag, purge_on_write, pages
+    enabled = kw.get('enabled', enabled)
+    default = kw.get('default', default)
+    ttl = kw.get('ttl', ttl)
+    vary = tuple(kw.get('vary', vary))
+    etag = kw.get('etag', etag)
+    purge_on_write = kw.get('purge_on_write', purge_on_write)
+    pages = LRUCache(maxsize=kw.get('maxsize', pages.maxsize), ttl=ttl)
+
+
+def clear():
+    pages.clear()
+
+
+def policy(request):
+    """
+    当前路由的缓存设置
+    :param request:
+    :return: (ttl, 额外的vary请求头), 不缓存(包括ttl为0)时返回None
+    """
+    cache = getattr(request.match_info.handler, 'cache', None)
+    if cache is None:
+        cache = default
+    if cache is False:
+        return None
+    if cache is True:
+        seconds, extra = ttl, ()
+    elif isinstance(cache, dict):
+        seconds, extra = cache.get('ttl', ttl), tuple(cache.get('vary', ()))
+    else:
+        seconds, extra = cache, ()
+    if not seconds:
+        return None
+    return seconds, extra
+
+
+def make_etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+def etag_matches(header, value):
+    """
+    If-None-Match按弱比较匹配
+    :param header: If-None-Match请求头
+    :param value: 响应的ETag
+    :return:
+    """
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == value:
+            return True
+    return False
+
+
+def not_modified(value):
+    return web.Response(status=304, headers={'ETag': value})
+
+
+def cacheable(resp):
+    """
+    只缓存已完整生成的200响应, 流式响应和设置cookie的响应不缓存
+    """
+    return isinstance(resp, web.Response) and resp.status == 200 and isinstance(resp.body, bytes) \
+        and 'Set-Cookie' not in resp.headers
+
+
+async def cache_factory(app, handler):
+    """
+      页面缓存中间件, 需要放在response_factory之前, 缓存的是最终的Response
+    :param app:
+    :param handler:
+    :return:
+    """
+
+    async def cached(request):
+        if not enabled:
+            return await handler(request)
+        if request.method != 'GET':
+            resp = await handler(request)
+            if purge_on_write and request.method in ('POST', 'PUT', 'PATCH', 'DELETE') \
+                    and getattr(resp, 'status', 200) < 400:
+                pages.clear()
+            return resp
+        route = policy(request)
+        key = None
+        if route is not None:
+            seconds, extra = route
+            key = (request.path_qs,) + tuple(request.headers.get(name) for name in vary + extra)
+            entry = pages.get(key)
+            if entry is not None:
+                status, headers, body, value = entry
+                if etag_matches(request.headers.get('If-None-Match'), value):
+                    return not_modified(value)
+                resp = web.Response(status=status, headers=headers, body=body)
+                resp.headers['X-Cache'] = 'HIT'
+                return resp
+        resp = await handler(request)
+        if (key is None and not etag) or not cacheable(resp):
+            return resp
+        value = make_etag(resp.body)
+        resp.headers['ETag'] = value
+        if key is not None:
+            headers = {k: v for k, v in resp.headers.items() if k not in _SKIP_HEADERS}
+            pages.set(key, (resp.status, headers, resp.body, value), ttl=seconds)
+            resp.headers['X-Cache'] = 'MISS'
+            logging.debug('page cached: %s', request.path_qs)
+        if etag_matches(request.headers.get('If-None-Match'), value):
+            return not_modified(value)
+        return resp
+
+    return cached
+
+
+@metrics.register
+def page_cache_metrics():
+    stats = pages.stats()
+    lines = []
+    for key in ('hits', 'misses', 'evictions'):
+        lines.append('# TYPE blogs_page_cache_%s_total counter' % key)
+        lines.append('blogs_page_cache_%s_total %s' % (key, stats[key]))
+    lines.append('# TYPE blogs_page_cache_size gauge')
+    lines.append('blogs_page_cache_size %s' % stats['size'])
+    return lines
@@ -0,0 +1,269 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  多进程启动器
+  父进程只负责管理worker: fork出N个worker, 每个worker有独立的事件循环和数据库连接池,
+  共享同一个监听端口(SO_REUSEPORT各自监听, 或继承父进程绑定的socket)
+    python -m blogs.server --workers 4 --port 9000
+  信号:
+    SIGTERM/SIGINT  优雅停止全部worker
+    SIGHUP          平滑替换worker: 先启动新worker, 新worker就绪后再优雅停止旧worker
+  SIGHUP只是替换worker进程(释放泄漏的内存, 重建连接池), 新worker由父进程fork,
+  沿用父进程已导入的代码和已加载的配置; 代码或配置修改后需要停止并重新启动整个服务
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+import tempfile
+import time
+
+from aiohttp import web
+
+from blogs import app as webapp
+from blogs.config import configs
+
+__author__ = 'boris han'
+
+# worker启动后存活不足该秒数即退出视为启动失败
+MIN_UPTIME = 5
+# 连续启动失败次数上限, 超过后停止整个服务
+MAX_BOOT_FAILURES = 5
+
+
+def create_socket(host, port, reuse_port=False, backlog=1024):
+    """
+    创建监听socket
+    :param host:
+    :param port:
+    :param reuse_port: 是否开启SO_REUSEPORT, 由内核在多个监听socket间分配连接
+    :param backlog:
+    :return:
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class Worker(object):
+    """
+      worker进程, 事件循环定时修改临时文件的权限位, 父进程通过文件ctime判断worker是否存活
+    """
+
+    def __init__(self, age):
+        # 启动序号, 平滑重启时先停止序号小的旧worker
+        self.age = age
+        self.pid = None
+        self.booted_at = time.monotonic()
+        self.terminating = False
+        fd, name = tempfile.mkstemp(prefix='blogs-worker-')
+        os.unlink(name)
+        self._heartbeat_fd = fd
+        self._created = os.fstat(fd).st_ctime
+        self._spin = 0
+
+    def notify(self):
+        self._spin = 1 - self._spin
+        os.fchmod(self._heartbeat_fd, self._spin)
+
+    def last_update(self):
+        return os.fstat(self._heartbeat_fd).st_ctime
+
+    def ready(self):
+        """
+        是否已完成初始化并开始处理请求(至少报告过一次心跳)
+        """
+        return self.last_update() != self._created
+
+    def close(self):
+        os.close(self._heartbeat_fd)
+
+    def run(self, sock, host, port, timeout, graceful_timeout, backlog=1024, keepalive_timeout=75):
+        """
+        子进程入口: 重新创建事件循环和连接池, 由aiohttp处理SIGTERM/SIGINT
+        应用, 连接池和心跳都在同一个事件循环上, 由run_app运行该循环
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        if sock is None:
+            sock = create_socket(host, port, reuse_port=True, backlog=backlog)
+        app = loop.run_until_complete(webapp.init(loop))
+
+        def heartbeat():
+            self.notify()
+            loop.call_later(timeout / 2.0, heartbeat)
+
+        loop.call_soon(heartbeat)
+        logging.info('worker %s listening on %s:%s.' % (os.getpid(), host, port))
+        web.run_app(app, sock=sock, shutdown_timeout=graceful_timeout, keepalive_timeout=keepalive_timeout,
+                    print=None, loop=loop)
+
+
+class Arbiter(object):
+    """
+      worker进程管理: 维持worker数量, 回收退出的worker, 杀掉心跳超时的worker
+    """
+
+    def __init__(self, host, port, workers=0, reuse_port=True, timeout=30, graceful_timeout=30, backlog=1024,
+                 keepalive_timeout=75):
+        self.host = host
+        self.port = port
+        self.num_workers = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port
+        self.timeout = timeout
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.keepalive_timeout = keepalive_timeout
+        self.workers = dict()
+        self.sock = None
+        self._age = 0
+        self._boot_failures = 0
+        self._signals = []
+
+    def run(self):
+        if not self.reuse_port:
+            self.sock = create_socket(self.host, self.port, backlog=self.backlog)
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, lambda signum, frame: self._signals.append(signum))
+        logging.info('arbiter %s starting %s workers on %s:%s.' % (os.getpid(), self.num_workers, self.host, self.port))
+        try:
+            while True:
+                sig = self._signals.pop(0) if self._signals else None
+                if sig in (signal.SIGTERM, signal.SIGINT):
+                    break
+                if sig == signal.SIGHUP:
+                    self.reload()
+                self.reap_workers()
+                if self._boot_failures >= MAX_BOOT_FAILURES:
+                    raise RuntimeError('worker failed to boot %s times.' % self._boot_failures)
+                self.murder_workers()
+                self.manage_workers()
+                time.sleep(0.5)
+        finally:
+            self.stop()
+
+    def spawn_worker(self):
+        self._age += 1
+        worker = Worker(self._age)
+        pid = os.fork()
+        if pid != 0:
+            worker.pid = pid
+            self.workers[pid] = worker
+            return worker
+        # 子进程
+        exit_code = 0
+        try:
+            worker.run(self.sock, self.host, self.port, self.timeout, self.graceful_timeout, self.backlog,
+                       self.keepalive_timeout)
+        except BaseException:
+            logging.exception('worker %s failed.' % os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def kill_worker(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            worker = self.workers.pop(pid, None)
+            if worker is not None:
+                worker.close()
+
+    def reap_workers(self):
+        """
+        回收已退出的worker
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            worker.close()
+            if status != 0 and time.monotonic() - worker.booted_at < MIN_UPTIME:
+                self._boot_failures += 1
+            else:
+                self._boot_failures = 0
+            logging.info('worker %s exited with status %s.' % (pid, status))
+
+    def murder_workers(self):
+        """
+        心跳超时的worker事件循环已阻塞, 直接SIGKILL
+        """
+        now = time.time()
+        for pid, worker in list(self.workers.items()):
+            if now - worker.last_update() > self.timeout:
+                logging.error('worker %s heartbeat timeout, killing.' % pid)
+                self.kill_worker(pid, signal.SIGKILL)
+
+    def manage_workers(self):
+        """
+        worker不足时启动新worker, 超出时(平滑重启后)待新worker全部就绪再优雅停止最旧的worker
+        """
+        workers = sorted(self.workers.values(), key=lambda w: w.age)
+        for _ in range(self.num_workers - len(workers)):
+            self.spawn_worker()
+        excess = len(workers) - self.num_workers
+        if excess > 0 and all(w.ready() for w in workers[excess:]):
+            for worker in workers[:excess]:
+                if not worker.terminating:
+                    worker.terminating = True
+                    self.kill_worker(worker.pid, signal.SIGTERM)
+
+    def reload(self):
+        """
+        替换全部worker, 新worker沿用父进程的代码和配置
+        """
+        logging.info('recycling workers: spawning %s new workers.' % self.num_workers)
+        for _ in range(self.num_workers):
+            self.spawn_worker()
+
+    def stop(self):
+        """
+        优雅停止全部worker, 超过graceful_timeout仍未退出的强制杀掉
+        """
+        if self.sock is not None:
+            self.sock.close()
+        for pid in list(self.workers):
+            self.kill_worker(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self.kill_worker(pid, signal.SIGKILL)
+        self.reap_workers()
+
+
+def main():
+    options = configs.server
+    parser = argparse.ArgumentParser(description='awesome blogs multi-worker server')
+    parser.add_argument('--host', default=options.host)
+    parser.add_argument('--port', type=int, default=options.port)
+    parser.add_argument('--workers', type=int, default=options.workers)
+    parser.add_argument('--no-reuse-port', dest='reuse_port', action='store_false', default=options.reuse_port)
+    parser.add_argument('--timeout', type=int, default=options.timeout)
+    parser.add_argument('--graceful-timeout', type=int, default=options.graceful_timeout)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    Arbiter(args.host, args.port, args.workers, args.reuse_port, args.timeout, args.graceful_timeout,
+            options.backlog, options.keepalive_timeout).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  请求跟踪: 按span统计一次请求在参数绑定, handler, SQL, 渲染, 编码上的耗时
+    with tracing.span(tracing.SQL):
+        ...
+  按sample_rate抽样, 未抽中的请求span()只做一次contextvar读取
+  抽中的请求写Server-Timing响应头, 并按路由汇总为直方图, 通过/metrics导出
+"""
+import contextvars
+import random
+import time
+
+from blogs import metrics
+
+__author__ = 'boris han'
+
+# span名称
+BIND = 'bind'
+HANDLER = 'handler'
+SQL = 'sql'
+RENDER = 'render'
+ENCODE = 'encode'
+TOTAL = 'total'
+
+# 是否开启跟踪
+enabled = True
+# 抽样比例0-1
+sample_rate = 0.01
+# 抽中的请求是否返回Server-Timing响应头
+server_timing = True
+# (路由, span) => Histogram
+spans = dict()
+
+_trace = contextvars.ContextVar('trace', default=None)
+
+
+def configure(**kw):
+    """
+    修改配置, 参数见config_default的tracing部分
+    :param kw: enabled, sample_rate, server_timing
+    :return:
+    """
+    global enabled, sample_rate, server_timing
+    enabled = kw.get('enabled', enabled)
+    sample_rate = kw.get('sample_rate', sample_rate)
+    server_timing = kw.get('server_timing', server_timing)
+
+
+class Trace(object):
+
+    __slots__ = ('route', 'start', 'spans')
+
+    def __init__(self, route):
+        self.route = route
+        self.start = time.perf_counter()
+        # span => [累计秒数, 次数], 按首次出现的顺序
+        self.spans = dict()
+
+    def add(self, name, elapsed):
+        item = self.spans.get(name)
+        if item is None:
+            self.spans[name] = [elapsed, 1]
+        else:
+            item[0] += elapsed
+            item[1] += 1
+
+    def server_timing(self):
+        """
+        Server-Timing响应头, 次数大于1的span在desc中注明次数
+        """
+        items = []
+        for name, (elapsed, count) in self.spans.items():
+            if count > 1:
+                items.append('%s;dur=%.3f;desc="%s calls"' % (name, elapsed * 1e3, count))
+            else:
+                items.append('%s;dur=%.3f' % (name, elapsed * 1e3))
+        return ', '.join(items)
+
+
+class Span(object):
+
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.add(self.name, time.perf_counter() - self.start)
+
+
+class NoopSpan(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NOOP = NoopSpan()
+
+
+def span(name):
+    """
+    当前请求的计时span, 请求未被抽中时返回空操作
+    :param name: span名称
+    :return: 上下文管理器
+    """
+    trace = _trace.get()
+    if trace is None:
+        return _NOOP
+    return Span(trace, name)
+
+
+def begin(request):
+    """
+    开始跟踪一个请求, 按sample_rate抽样
+    :param request: 按请求的路由汇总
+    :return: (Trace, token), 未抽中时为(None, None)
+    """
+    if not enabled or random.random() >= sample_rate:
+        return None, None
+    trace = Trace(route_name(request))
+    return trace, _trace.set(trace)
+
+
+def end(trace, token):
+    """
+    结束跟踪, 汇总到路由的直方图
+    :return:
+    """
+    if trace is None:
+        return
+    _trace.reset(token)
+    trace.add(TOTAL, time.perf_counter() - trace.start)
+    for name, (elapsed, count) in trace.spans.items():
+        key = (trace.route, name)
+        histogram = spans.get(key)
+        if histogram is None:
+            histogram = spans[key] = metrics.Histogram()
+        histogram.observe(elapsed)
+
+
+def route_name(request):
+    """
+    路由模板, 如/blog/{id}, 同一路由的请求汇总在一起
+    """
+    route = getattr(request.match_info, 'route', None)
+    resource = getattr(route, 'resource', None)
+    return resource.canonical if resource is not None else 'unmatched'
+
+
+@metrics.register
+def tracing_metrics():
+    lines = ['# HELP blogs_trace_span_seconds Time spent per request in each span, sampled.',
+             '# TYPE blogs_trace_span_seconds histogram']
+    for (route, name), histogram in spans.items():
+        lines.extend(histogram.samples('blogs_trace_span_seconds',
+                                       'route="%s",span="%s"' % (metrics.escape(route), name)))
+    return lines
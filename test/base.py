@@ -0,0 +1,31 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  测试基类: 每个测试使用新的sqlite内存库, 不需要MySQL
+"""
+import unittest
+
+from blogs import Orm
+from blogs.entity import Blog, Comment, Customer
+
+__author__ = 'boris han'
+
+MODELS = (Customer, Blog, Comment)
+
+
+class DatabaseTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        await Orm.create_pool(None, backend='sqlite', minsize=1, maxsize=4)
+        await Orm.create_tables(*MODELS)
+        # 实体缓存是进程级的, 不能带到下一个测试
+        for model in MODELS:
+            if model.__entity_cache__ is not None:
+                model.__entity_cache__.clear()
+
+    async def asyncTearDown(self):
+        await Orm.close_pool()
+
+    async def count(self, model, where=None, args=None):
+        return await model.find_total('count(*) __num__', where, args)
@@ -0,0 +1,45 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  聚合查询: aggregate/count_in
+"""
+import unittest
+
+from blogs.entity import Comment
+from test.base import DatabaseTestCase
+
+__author__ = 'boris han'
+
+
+class AggregateTest(DatabaseTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        await Comment.save_many([Comment(blog_id='b%s' % (i % 3), content='c', created_at=float(i))
+                                 for i in range(10)])
+
+    async def test_aggregate(self):
+        result = await Comment.aggregate(count='*', min='created_at', max='created_at')
+        self.assertEqual((result['count'], result['min'], result['max']), (10, 0.0, 9.0))
+
+    async def test_aggregate_group_by(self):
+        rows = await Comment.aggregate(group_by='blog_id', order_by='`blog_id`', count='id', sum='created_at')
+        self.assertEqual([(row['blog_id'], row['count'], row['sum']) for row in rows],
+                         [('b0', 4, 18.0), ('b1', 3, 12.0), ('b2', 3, 15.0)])
+
+    async def test_aggregate_unknown(self):
+        with self.assertRaises(ValueError):
+            await Comment.aggregate(count='nope')
+        with self.assertRaises(ValueError):
+            await Comment.aggregate(median='created_at')
+
+    async def test_count_in(self):
+        counts = await Comment.count_in('blog_id', ['b0', 'b2', 'b9', 'b0'])
+        self.assertEqual(counts, {'b0': 4, 'b2': 3, 'b9': 0})
+        self.assertEqual(await Comment.count_in('blog_id', ['b0'], '`created_at` > ?', [5.0]), {'b0': 2})
+        self.assertEqual(await Comment.count_in('blog_id', []), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
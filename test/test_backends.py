@@ -0,0 +1,68 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  sqlite后端: 占位符转换, 建表语句, 游标, 连接池的事务锁
+"""
+import asyncio
+import contextvars
+import unittest
+
+from blogs import Orm, backends
+from blogs.entity import Blog
+from test.base import DatabaseTestCase
+
+__author__ = 'boris han'
+
+
+class SQLTest(unittest.TestCase):
+
+    def test_to_qmark(self):
+        self.assertEqual(backends.to_qmark("select * from t where a=%s and b like '10%%'"),
+                         "select * from t where a=? and b like '10%'")
+
+    def test_create_table_sql(self):
+        sql = Orm.create_table_sql(Blog)
+        self.assertTrue(sql.startswith('create table if not exists `blog`'))
+        self.assertIn('`id` varchar(50) not null', sql)
+        self.assertIn('`created_at` real', sql)
+        self.assertIn('primary key (`id`)', sql)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            backends.get_backend('oracle')
+
+
+class SQLiteBackendTest(DatabaseTestCase):
+
+    async def test_cursor_kinds(self):
+        await Blog(id='b1', name='one', created_at=1.0).save()
+        sql = 'select `id`, `name` from `blog` where `id`=?'
+        self.assertEqual(await Orm.fetch(sql, ['b1']), [{'id': 'b1', 'name': 'one'}])
+        self.assertEqual(await Orm.fetch(sql, ['b1'], cursor=backends.TUPLE), [('b1', 'one')])
+        self.assertEqual(await Orm.fetch(sql, ['missing']), [])
+
+    async def test_create_tables_is_idempotent(self):
+        await Orm.create_tables(Blog)
+        self.assertEqual(await self.count(Blog), 0)
+
+    async def test_other_connections_wait_for_transaction(self):
+        order = []
+
+        async def reader():
+            order.append(('read', await self.count(Blog)))
+
+        async with Orm.transaction():
+            await Blog(name='pending').save()
+            # 新的上下文, 不使用事务的连接
+            task = asyncio.get_running_loop().create_task(reader(), context=contextvars.Context())
+            await asyncio.sleep(0.01)
+            # 事务提交前其他连接的SQL不执行, 读不到未提交的数据
+            self.assertFalse(task.done())
+            order.append(('commit', None))
+        await task
+        self.assertEqual(order, [('commit', None), ('read', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  批量写入: save_many/modify_many/remove_many
+"""
+import unittest
+
+from blogs.entity import Blog
+from test.base import DatabaseTestCase
+
+__author__ = 'boris han'
+
+
+class BatchTest(DatabaseTestCase):
+
+    async def test_save_modify_remove_many(self):
+        blogs = [Blog(name='blog%s' % i, created_at=float(i)) for i in range(25)]
+        self.assertEqual(await Blog.save_many(blogs, batch_size=10), 25)
+        self.assertEqual(await self.count(Blog), 25)
+
+        for blog in blogs[:12]:
+            blog.name = 'changed'
+        self.assertEqual(await Blog.modify_many(blogs[:12], batch_size=5), 12)
+        self.assertEqual(await self.count(Blog, '`name`=?', ['changed']), 12)
+
+        self.assertEqual(await Blog.remove_many([blog.id for blog in blogs[:7]], batch_size=3), 7)
+        self.assertEqual(await self.count(Blog), 18)
+        self.assertIsNone(await Blog.find(blogs[0].id))
+
+    async def test_empty_batches(self):
+        self.assertEqual(await Blog.save_many([]), 0)
+        self.assertEqual(await Blog.modify_many([]), 0)
+        self.assertEqual(await Blog.remove_many([]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
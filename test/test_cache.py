@@ -0,0 +1,70 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  实体缓存: 写操作失效, 与写操作并发的读取
+"""
+import asyncio
+import unittest
+from unittest import mock
+
+from blogs import Orm
+from blogs.entity import Customer
+from test.base import DatabaseTestCase
+
+__author__ = 'boris han'
+
+
+class EntityCacheTest(DatabaseTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.cache = Customer.__entity_cache__
+        self.customer = Customer(name='old', email='old@example.com')
+        await self.customer.save()
+
+    async def rename(self, name):
+        self.customer.name = name
+        await self.customer.modify()
+
+    async def test_find_uses_cache(self):
+        await Customer.find(self.customer.id)
+        first = await Customer.find(self.customer.id)
+        self.assertEqual(self.cache.rows.hits, 1)
+        # 返回副本, 修改不会污染缓存
+        first.name = 'dirty'
+        self.assertEqual((await Customer.find(self.customer.id)).name, 'old')
+
+    async def test_write_invalidates(self):
+        await Customer.find(self.customer.id)
+        await Customer.find_all(order_by='`name`')
+        await self.rename('new')
+        self.assertIsNone(self.cache.rows.get(self.customer.id))
+        self.assertEqual(len(self.cache.queries), 0)
+        self.assertEqual((await Customer.find(self.customer.id)).name, 'new')
+        self.assertEqual([c.name for c in await Customer.find_all(order_by='`name`')], ['new'])
+
+    async def test_batch_write_invalidates(self):
+        await Customer.find(self.customer.id)
+        await Customer.remove_many([self.customer.id])
+        self.assertIsNone(await Customer.find(self.customer.id))
+
+    async def test_read_racing_write_is_not_cached(self):
+        fetch = Orm.fetch
+
+        async def slow_fetch(*args, **kw):
+            rs = await fetch(*args, **kw)
+            await asyncio.sleep(0.01)
+            return rs
+
+        with mock.patch.object(Orm, 'fetch', slow_fetch):
+            read = asyncio.ensure_future(Customer.find(self.customer.id))
+            await asyncio.sleep(0)
+            await self.rename('new')
+            self.assertEqual((await read).name, 'old')
+        self.assertIsNone(self.cache.rows.get(self.customer.id))
+        self.assertEqual((await Customer.find(self.customer.id)).name, 'new')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  并发请求合并: 共用结果, 异常传播, 第一个请求取消后重试, 计数
+"""
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from blogs.apis import APIError
+from blogs.CoroutineWeb import RequestHandler, coalesce_stats, get, prepare_handler
+
+__author__ = 'boris han'
+
+
+class CoalesceTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        coalesce_stats.clear()
+        self.addCleanup(coalesce_stats.clear)
+        self.gate = asyncio.Event()
+        self.calls = []
+
+    def handler(self, fn, coalesce=True):
+        return RequestHandler(None, prepare_handler(get('/hot', coalesce=coalesce)(fn)))
+
+    async def gather(self, handler, *paths):
+        tasks = [asyncio.ensure_future(handler(make_mocked_request('GET', path))) for path in paths]
+        # 等所有请求进入handler
+        for _ in range(3):
+            await asyncio.sleep(0)
+        return tasks
+
+    async def test_share_result(self):
+        async def hot(*, id):
+            self.calls.append(id)
+            await self.gate.wait()
+            return dict(id=id, calls=len(self.calls))
+
+        handler = self.handler(hot)
+        tasks = await self.gather(handler, '/hot?id=1', '/hot?id=1', '/hot?id=2', '/hot?id=1')
+        self.gate.set()
+        results = await asyncio.gather(*tasks)
+        self.assertEqual(sorted(self.calls), ['1', '2'])
+        self.assertEqual([r['id'] for r in results], ['1', '1', '2', '1'])
+        self.assertIs(results[0], results[1])
+        self.assertEqual(coalesce_stats['/hot'], [4, 2])
+        self.assertEqual(handler._inflight, {})
+
+    async def test_response_is_copied(self):
+        async def hot():
+            self.calls.append(1)
+            await self.gate.wait()
+            return web.Response(body=b'page')
+
+        tasks = await self.gather(self.handler(hot), '/hot', '/hot')
+        self.gate.set()
+        first, second = await asyncio.gather(*tasks)
+        self.assertIsNot(first, second)
+        self.assertEqual((first.body, second.body), (b'page', b'page'))
+        self.assertEqual(len(self.calls), 1)
+
+    async def test_api_error_propagates(self):
+        async def hot():
+            self.calls.append(1)
+            await self.gate.wait()
+            raise APIError('hot:failed', 'hot', 'boom')
+
+        tasks = await self.gather(self.handler(hot), '/hot', '/hot', '/hot')
+        self.gate.set()
+        results = await asyncio.gather(*tasks)
+        self.assertEqual(results, [dict(error='hot:failed', data='hot', message='boom')] * 3)
+        self.assertEqual(len(self.calls), 1)
+
+    async def test_cancelled_leader_retries(self):
+        async def hot():
+            self.calls.append(1)
+            if len(self.calls) == 1:
+                await self.gate.wait()
+            return 'page'
+
+        leader, *followers = await self.gather(self.handler(hot), '/hot', '/hot', '/hot')
+        leader.cancel()
+        self.assertEqual(await asyncio.gather(*followers), ['page', 'page'])
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        self.assertEqual(len(self.calls), 3)
+
+    async def test_off_by_default(self):
+        async def hot():
+            self.calls.append(1)
+            await self.gate.wait()
+            return 'page'
+
+        tasks = await self.gather(self.handler(hot, coalesce=None), '/hot', '/hot')
+        self.gate.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(coalesce_stats, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  响应压缩: 压缩结果稳定, Vary追加, 静态文件遵守q=0
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from blogs import compress, page_cache
+from blogs.CoroutineWeb import add_route, get
+from blogs.app import response_factory
+
+__author__ = 'boris han'
+
+PAGE = ('<p>compressible page</p>' * 200).encode('utf-8')
+
+
+class CompressTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.static = tempfile.mkdtemp(prefix='blogs-static-')
+        self.addCleanup(shutil.rmtree, self.static)
+        with open(os.path.join(self.static, 'site.css'), 'wb') as f:
+            f.write(PAGE)
+        compress.precompress(self.static)
+
+        @get('/page')
+        async def page():
+            resp = web.Response(body=PAGE, content_type='text/html')
+            resp.headers['Vary'] = 'Cookie'
+            return resp
+
+        app = web.Application(middlewares=[page_cache.cache_factory, compress.compress_factory,
+                                           response_factory])
+        add_route(app, page)
+        app.router.add_get('/static/{filename:.*}', compress.static_handler(self.static))
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+        self.addAsyncCleanup(self.client.close)
+
+    async def fetch(self, path, **headers):
+        resp = await self.client.get(path, headers=headers)
+        return resp.status, resp.headers, await resp.read()
+
+    async def test_gzip_etag_survives_revalidation(self):
+        self.assertEqual(compress.compress(PAGE, 'gzip'), compress.compress(PAGE, 'gzip'))
+        _, headers, body = await self.fetch('/page', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual((headers['Content-Encoding'], body), ('gzip', PAGE))
+        # gzip头部的mtime精确到秒, 跨过1秒后ETag仍然相同
+        await asyncio.sleep(1.1)
+        status, _, _ = await self.fetch('/page', **{'Accept-Encoding': 'gzip', 'If-None-Match': headers['ETag']})
+        self.assertEqual(status, 304)
+
+    async def test_vary_is_appended(self):
+        _, headers, _ = await self.fetch('/page', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(headers['Vary'], 'Cookie, Accept-Encoding')
+        _, headers, _ = await self.fetch('/page', **{'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(headers['Vary'], 'Cookie, Accept-Encoding')
+
+    async def test_static_precompressed(self):
+        _, headers, body = await self.fetch('/static/site.css', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual((headers['Content-Encoding'], body), ('gzip', PAGE))
+
+    async def test_static_respects_q_zero(self):
+        _, headers, body = await self.fetch('/static/site.css', **{'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(body, PAGE)
+
+    async def test_static_stays_in_root(self):
+        status, _, _ = await self.fetch('/static/..%2F..%2Fetc%2Fhostname')
+        self.assertEqual(status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  配置: 环境变量按默认值类型转换, 冻结后的配置节点
+"""
+import unittest
+
+from blogs.config import ConfigNode, env_overrides, freeze, merge, to_dict
+
+__author__ = 'boris han'
+
+DEFAULTS = {
+    'db': {'host': '127.0.0.1', 'password': 'secret', 'maxsize': 10, 'adaptive_wait': 0.005, 'warm': True,
+           'replicas': []},
+    'templates': {'bytecode_cache': None},
+}
+
+
+class EnvOverridesTest(unittest.TestCase):
+
+    def overrides(self, **environ):
+        return env_overrides(environ, DEFAULTS)
+
+    def test_types_follow_defaults(self):
+        result = self.overrides(AWESOME_DB__PASSWORD='123456', AWESOME_DB__MAXSIZE='50',
+                                AWESOME_DB__ADAPTIVE_WAIT='1', AWESOME_DB__WARM='false',
+                                AWESOME_DB__REPLICAS='[{"host": "10.0.0.2"}]')
+        self.assertEqual(result['db'], {'password': '123456', 'maxsize': 50, 'adaptive_wait': 1.0, 'warm': False,
+                                        'replicas': [{'host': '10.0.0.2'}]})
+
+    def test_none_and_unknown_keys_parse_json(self):
+        result = self.overrides(AWESOME_TEMPLATES__BYTECODE_CACHE='/var/cache/blogs', AWESOME_DB__TIMEOUT='5')
+        self.assertEqual(result['templates']['bytecode_cache'], '/var/cache/blogs')
+        self.assertEqual(result['db']['timeout'], 5)
+
+    def test_invalid_value(self):
+        with self.assertRaises(ValueError):
+            self.overrides(AWESOME_DB__MAXSIZE='many')
+        with self.assertRaises(ValueError):
+            self.overrides(AWESOME_DB__WARM='maybe')
+
+    def test_ignores_other_variables(self):
+        self.assertEqual(self.overrides(PATH='/bin', AWESOME_='x', AWESOME_DB____HOST='x'), {})
+
+
+class FreezeTest(unittest.TestCase):
+
+    def test_attribute_and_item_access(self):
+        configs = freeze(merge(DEFAULTS, {'db': {'host': '10.0.0.1'}}))
+        self.assertEqual(configs.db.host, '10.0.0.1')
+        self.assertEqual(configs['db']['maxsize'], 10)
+        self.assertEqual(configs.db.replicas, ())
+        self.assertIsInstance(configs.db, ConfigNode)
+        with self.assertRaises(AttributeError):
+            configs.db.host = 'localhost'
+
+    def test_keys_that_are_not_attributes(self):
+        configs = freeze({'entity_cache': {'blog-posts': {'ttl': 5}, 'items': {'ttl': 6}, 'customers': {'ttl': 7}}})
+        cache = configs.entity_cache
+        self.assertEqual(cache['blog-posts'].ttl, 5)
+        self.assertEqual(cache['items'].ttl, 6)
+        self.assertEqual(cache.customers.ttl, 7)
+        self.assertEqual(to_dict(cache), {'blog-posts': {'ttl': 5}, 'items': {'ttl': 6}, 'customers': {'ttl': 7}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  批量加载: 合并同一轮的load, 请求内去重, 加载范围之外不保留结果
+"""
+import asyncio
+import unittest
+from unittest import mock
+
+from blogs import Orm, loader
+from blogs.entity import Blog, Customer
+from test.base import DatabaseTestCase
+
+__author__ = 'boris han'
+
+
+class LoaderTest(DatabaseTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.blogs = [Blog(name='blog%s' % i) for i in range(5)]
+        await Blog.save_many(self.blogs)
+        self.queries = []
+        fetch = Orm.fetch
+
+        async def counting_fetch(sql, args, *rest, **kw):
+            self.queries.append(list(args))
+            return await fetch(sql, args, *rest, **kw)
+
+        patcher = mock.patch.object(Orm, 'fetch', counting_fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_batch_and_dedupe(self):
+        token = loader.begin()
+        try:
+            ids = [self.blogs[0].id, self.blogs[1].id, self.blogs[0].id, 'missing']
+            found = await Blog.load_many(ids)
+            self.assertEqual([b and b.name for b in found], ['blog0', 'blog1', 'blog0', None])
+            self.assertIs(found[0], found[2])
+            self.assertEqual(len(self.queries), 1)
+            self.assertEqual(len(self.queries[0]), 3)
+            # 同一请求内再次加载不查询
+            self.assertEqual((await Blog.load(self.blogs[1].id)).name, 'blog1')
+            self.assertEqual(len(self.queries), 1)
+        finally:
+            loader.end(token)
+
+    async def test_scopes_are_separate(self):
+        for _ in range(2):
+            token = loader.begin()
+            try:
+                await Blog.load(self.blogs[2].id)
+            finally:
+                loader.end(token)
+        self.assertEqual(len(self.queries), 2)
+
+    async def test_outside_scope_does_not_cache(self):
+        first = await asyncio.gather(Blog.load(self.blogs[3].id), Blog.load(self.blogs[3].id))
+        self.assertIs(first[0], first[1])
+        self.assertEqual(len(self.queries), 1)
+        await Blog.load(self.blogs[3].id)
+        self.assertEqual(len(self.queries), 2)
+        self.assertIsNone(loader._loaders.get())
+
+    async def test_failed_batch_is_not_cached(self):
+        failures = [RuntimeError('down')]
+
+        async def batch_fn(keys):
+            if failures:
+                raise failures.pop()
+            return await Blog.find_many(keys)
+
+        token = loader.begin()
+        try:
+            batch = loader.get_loader(('flaky',), batch_fn)
+            with self.assertRaises(RuntimeError):
+                await batch.load(self.blogs[4].id)
+            self.assertEqual((await batch.load(self.blogs[4].id)).name, 'blog4')
+        finally:
+            loader.end(token)
+
+
+class FindManyTest(DatabaseTestCase):
+
+    async def test_find_many(self):
+        customers = [Customer(name='user%s' % i) for i in range(5)]
+        await Customer.save_many(customers)
+        found = await Customer.find_many([customers[0].id, customers[3].id, 'missing', customers[0].id])
+        self.assertEqual(set(found), {customers[0].id, customers[3].id})
+        self.assertEqual(found[customers[3].id].name, 'user3')
+
+
+if __name__ == '__main__':
+    unittest.main()
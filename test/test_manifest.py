@@ -0,0 +1,114 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  路由清单: 按清单延迟注册, 模块变化时重新生成, 清单目录不可用时退回, 清单与模块不一致时拒绝
+"""
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from blogs import CoroutineWeb
+from blogs.CoroutineWeb import LazyRequestHandler, RequestHandler, add_routes, load_manifest
+
+__author__ = 'boris han'
+
+MODULE = 'manifest_handlers'
+
+SOURCE = '''
+from blogs.CoroutineWeb import get
+
+
+@get('/index')
+async def index(*, page='1'):
+    return 'index %s' % page
+'''
+
+EXTRA = '''
+
+@get('/about')
+async def about():
+    return 'about'
+'''
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='blogs-manifest-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.manifest_dir = os.path.join(self.root, 'manifests')
+        sys.path.insert(0, self.root)
+        self.addCleanup(sys.path.remove, self.root)
+        self.addCleanup(self.unload)
+        self.mtime = 1000000000
+        self.write(SOURCE)
+        self.builds = mock.patch.object(CoroutineWeb, 'build_manifest', wraps=CoroutineWeb.build_manifest).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def unload(self):
+        sys.modules.pop(MODULE, None)
+
+    def write(self, source):
+        path = os.path.join(self.root, MODULE + '.py')
+        with open(path, 'w') as f:
+            f.write(source)
+        # 每次修改使用不同的mtime, 不依赖文件系统的时间精度
+        self.mtime += 10
+        os.utime(path, (self.mtime, self.mtime))
+        importlib.invalidate_caches()
+        self.unload()
+
+    def routes(self):
+        return sorted(entry['path'] for entry in load_manifest(MODULE, self.manifest_dir))
+
+    def test_lazy_routes_skip_import(self):
+        self.assertEqual(self.routes(), ['/index'])
+        self.unload()
+        app = web.Application()
+        add_routes(app, MODULE, lazy=True, manifest_dir=self.manifest_dir)
+        self.assertEqual(self.builds.call_count, 1)
+        self.assertNotIn(MODULE, sys.modules)
+        handler = [r.handler for r in app.router.routes() if r.method == 'GET'][0]
+        self.assertIsInstance(handler, LazyRequestHandler)
+        self.assertIsInstance(handler.resolve(), RequestHandler)
+        self.assertIn(MODULE, sys.modules)
+
+    def test_rebuild_on_change(self):
+        self.assertEqual(self.routes(), ['/index'])
+        self.assertEqual(self.routes(), ['/index'])
+        self.assertEqual(self.builds.call_count, 1)
+        # 大小和mtime都变化
+        self.write(SOURCE + EXTRA)
+        self.assertEqual(self.routes(), ['/about', '/index'])
+        self.assertEqual(self.builds.call_count, 2)
+        # 只有mtime变化
+        self.write(SOURCE + EXTRA)
+        self.routes()
+        self.assertEqual(self.builds.call_count, 3)
+
+    def test_unwritable_dir_falls_back(self):
+        blocker = os.path.join(self.root, 'file')
+        open(blocker, 'w').close()
+        app = web.Application()
+        add_routes(app, MODULE, lazy=True, manifest_dir=os.path.join(blocker, 'sub'))
+        handlers = [r.handler for r in app.router.routes() if r.method == 'GET']
+        self.assertEqual(len(handlers), 1)
+        self.assertIsInstance(handlers[0], RequestHandler)
+
+    def test_mismatched_entry_is_rejected(self):
+        entry = load_manifest(MODULE, self.manifest_dir)[0]
+        for name, value in (('path', '/other'), ('method', 'POST'), ('name', 'missing')):
+            handler = LazyRequestHandler(None, MODULE, dict(entry, **{name: value}))
+            with self.assertRaises(RuntimeError):
+                handler.resolve()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  页面缓存: 命中/未命中, 304, vary请求头, 写请求清空缓存
+"""
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from blogs import page_cache
+from blogs.CoroutineWeb import add_route, get, post
+from blogs.app import response_factory
+
+__author__ = 'boris han'
+
+
+class PageCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        saved = dict(enabled=page_cache.enabled, default=page_cache.default, ttl=page_cache.ttl,
+                     vary=page_cache.vary, etag=page_cache.etag, purge_on_write=page_cache.purge_on_write,
+                     maxsize=page_cache.pages.maxsize)
+        self.addCleanup(page_cache.configure, **saved)
+        page_cache.configure(enabled=True, default=False, ttl=10, vary=('Accept-Language',), etag=True,
+                             purge_on_write=True)
+        self.calls = dict()
+
+        def counted(name, body):
+            async def handler():
+                self.calls[name] = self.calls.get(name, 0) + 1
+                return body
+            handler.__name__ = name
+            return handler
+
+        app = web.Application(middlewares=[page_cache.cache_factory, response_factory])
+        add_route(app, get('/cached', cache=True)(counted('cached', 'cached page')))
+        add_route(app, get('/short', cache=0.05)(counted('short', 'short page')))
+        add_route(app, get('/zero', cache=0)(counted('zero', 'zero page')))
+        add_route(app, get('/plain')(counted('plain', 'plain page')))
+        add_route(app, post('/write')(counted('write', 'ok')))
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+        self.addAsyncCleanup(self.client.close)
+
+    async def fetch(self, path, **headers):
+        resp = await self.client.get(path, headers=headers)
+        return resp.status, resp.headers, await resp.read()
+
+    async def test_miss_then_hit(self):
+        status, headers, body = await self.fetch('/cached')
+        self.assertEqual((status, headers['X-Cache'], body), (200, 'MISS', b'cached page'))
+        status, headers, body = await self.fetch('/cached')
+        self.assertEqual((status, headers['X-Cache'], body), (200, 'HIT', b'cached page'))
+        self.assertEqual(self.calls['cached'], 1)
+
+    async def test_not_modified_skips_handler(self):
+        _, headers, _ = await self.fetch('/cached')
+        status, headers, body = await self.fetch('/cached', **{'If-None-Match': headers['ETag']})
+        self.assertEqual((status, body), (304, b''))
+        self.assertEqual(self.calls['cached'], 1)
+
+    async def test_uncached_page_still_revalidates(self):
+        _, headers, _ = await self.fetch('/plain')
+        self.assertNotIn('X-Cache', headers)
+        status, _, _ = await self.fetch('/plain', **{'If-None-Match': headers['ETag']})
+        self.assertEqual(status, 304)
+        self.assertEqual(self.calls['plain'], 2)
+
+    async def test_vary_headers_in_key(self):
+        await self.fetch('/cached', **{'Accept-Language': 'en'})
+        _, headers, _ = await self.fetch('/cached', **{'Accept-Language': 'zh'})
+        self.assertEqual(headers['X-Cache'], 'MISS')
+        _, headers, _ = await self.fetch('/cached', **{'Accept-Language': 'en'})
+        self.assertEqual(headers['X-Cache'], 'HIT')
+        self.assertEqual(self.calls['cached'], 2)
+
+    async def test_post_purges(self):
+        await self.fetch('/cached')
+        resp = await self.client.post('/write', json={})
+        self.assertEqual(resp.status, 200)
+        _, headers, _ = await self.fetch('/cached')
+        self.assertEqual(headers['X-Cache'], 'MISS')
+        self.assertEqual(self.calls['cached'], 2)
+
+    async def test_ttl_expires(self):
+        await self.fetch('/short')
+        await asyncio.sleep(0.1)
+        _, headers, _ = await self.fetch('/short')
+        self.assertEqual(headers['X-Cache'], 'MISS')
+        self.assertEqual(self.calls['short'], 2)
+
+    async def test_zero_ttl_is_not_cached(self):
+        for _ in range(2):
+            _, headers, _ = await self.fetch('/zero')
+            self.assertNotIn('X-Cache', headers)
+        self.assertEqual(self.calls['zero'], 2)
+        self.assertEqual(len(page_cache.pages), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
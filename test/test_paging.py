@@ -0,0 +1,52 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  keyset分页
+"""
+import unittest
+
+from blogs import Orm
+from blogs.apis import APIError
+from blogs.entity import Blog
+from test.base import DatabaseTestCase
+
+__author__ = 'boris han'
+
+
+class KeysetTest(DatabaseTestCase):
+
+    async def test_pages_with_tied_created_at(self):
+        # 一半记录created_at相同, 只按created_at分页会漏掉或重复
+        blogs = [Blog(name='blog%s' % i, created_at=100.0 if i % 2 else float(i)) for i in range(11)]
+        await Blog.save_many(blogs)
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = await Blog.find_all(page_size=3, after=cursor)
+            seen.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 11)
+        self.assertEqual({b.id for b in seen}, {b.id for b in blogs})
+        keys = [(b.created_at, b.id) for b in seen]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    async def test_where_and_last_page(self):
+        await Blog.save_many([Blog(name='a' if i < 4 else 'b', created_at=float(i)) for i in range(8)])
+        page, cursor = await Blog.find_all('`name`=?', ['a'], page_size=4)
+        self.assertEqual(len(page), 4)
+        self.assertIsNone(cursor)
+
+    async def test_invalid_cursor(self):
+        for cursor in ('not a cursor', Orm.encode_cursor(1.0), Orm.encode_cursor({'a': 1}, 'x')):
+            with self.assertRaises(APIError):
+                await Blog.find_all(page_size=3, after=cursor)
+
+    async def test_page_size_with_limit(self):
+        with self.assertRaises(ValueError):
+            await Blog.find_all(page_size=3, limit=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  只读从库: 读写分离, 写入实体缓存的查询走主库
+"""
+import asyncio
+import contextvars
+import unittest
+
+from blogs import Orm
+from blogs.entity import Blog, Customer
+from test.base import MODELS, DatabaseTestCase
+
+__author__ = 'boris han'
+
+
+def other_request(coro):
+    """
+    在新的上下文中执行, 模拟没有写过数据的其他请求
+    """
+    return asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+
+
+class ReplicaTest(DatabaseTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        await Orm.close_pool()
+        # 每个sqlite内存库相互独立, 从库中的数据模拟复制延迟
+        await Orm.create_pool(None, backend='sqlite', minsize=1, maxsize=4, replicas=[{}])
+        await Orm.create_tables(*MODELS)
+        self.replica = Orm.all_pools()[1].pool.db
+        for model in MODELS:
+            self.replica.execute(Orm.create_table_sql(model))
+
+    def replicate(self, obj):
+        # 从库上的旧数据
+        columns = [obj.__primary_key__] + list(obj.__fields__)
+        self.replica.execute('insert into `%s` (%s) values (%s)' % (
+            obj.__table__, ', '.join('`%s`' % c for c in columns), ', '.join('?' * len(columns))),
+            [obj.get_value(c) for c in columns])
+
+    async def test_reads_use_replica(self):
+        blog = Blog(name='primary')
+        await blog.save()
+        blog.name = 'replica'
+        self.replicate(blog)
+        self.assertEqual((await other_request(Blog.find(blog.id))).name, 'replica')
+        # 刚写过数据的请求读主库
+        self.assertEqual((await Blog.find(blog.id)).name, 'primary')
+
+    async def test_cache_fills_read_primary(self):
+        customer = Customer(name='new', email='new@example.com')
+        await customer.save()
+        customer.name = 'stale'
+        self.replicate(customer)
+        self.assertEqual((await other_request(Customer.find(customer.id))).name, 'new')
+        self.assertEqual(Customer.__entity_cache__.rows.get(customer.id).name, 'new')
+        found = await other_request(Customer.find_many([customer.id]))
+        self.assertEqual(found[customer.id].name, 'new')
+        rs = await other_request(Customer.find_all('`id`=?', [customer.id]))
+        self.assertEqual([c.name for c in rs], ['new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  事务: 提交, 回滚, 保存点, 提交后失效实体缓存
+"""
+import asyncio
+import contextvars
+import unittest
+
+from blogs import Orm
+from blogs.entity import Blog, Comment, Customer
+from test.base import DatabaseTestCase
+
+__author__ = 'boris han'
+
+
+def outside_transaction(coro):
+    """
+    在新的上下文中执行, 模拟事务之外的其他请求
+    """
+    return asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+
+
+class TransactionTest(DatabaseTestCase):
+
+    async def test_commit(self):
+        async with Orm.transaction():
+            await Blog(name='one').save()
+            await Comment.save_many([Comment(blog_id='b', content='c%s' % i) for i in range(3)])
+        self.assertEqual(await self.count(Blog), 1)
+        self.assertEqual(await self.count(Comment), 3)
+
+    async def test_rollback(self):
+        with self.assertRaises(RuntimeError):
+            async with Orm.transaction():
+                await Blog(name='one').save()
+                await Blog.save_many([Blog(name='two'), Blog(name='three')])
+                raise RuntimeError('abort')
+        self.assertEqual(await self.count(Blog), 0)
+        self.assertFalse(Orm.in_transaction())
+
+    async def test_savepoint(self):
+        async with Orm.transaction():
+            await Blog(name='outer').save()
+            with self.assertRaises(RuntimeError):
+                async with Orm.transaction():
+                    await Blog(name='inner').save()
+                    raise RuntimeError('abort inner')
+            await Blog(name='after').save()
+        names = {blog.name for blog in await Blog.find_all()}
+        self.assertEqual(names, {'outer', 'after'})
+
+    async def test_batch_commit(self):
+        with self.assertRaises(RuntimeError):
+            async with Orm.transaction() as tx:
+                await Blog(name='kept').save()
+                await tx.commit()
+                await Blog(name='lost').save()
+                raise RuntimeError('abort')
+        self.assertEqual([blog.name for blog in await Blog.find_all()], ['kept'])
+
+
+class TransactionCacheTest(DatabaseTestCase):
+    """
+      事务中写操作的实体缓存失效推迟到提交之后
+    """
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.cache = Customer.__entity_cache__
+        self.customer = Customer(name='old', email='old@example.com')
+        await self.customer.save()
+
+    async def rename(self, name):
+        self.customer.name = name
+        await self.customer.modify()
+
+    async def test_invalidate_after_commit(self):
+        await Customer.find(self.customer.id)
+        async with Orm.transaction():
+            await self.rename('new')
+            # 提交前其他请求读到的仍是旧数据, 缓存保持不变
+            self.assertEqual(self.cache.rows.get(self.customer.id).name, 'old')
+        self.assertIsNone(self.cache.rows.get(self.customer.id))
+        found = await outside_transaction(Customer.find(self.customer.id))
+        self.assertEqual(found.name, 'new')
+
+    async def test_rollback_keeps_cache(self):
+        await Customer.find(self.customer.id)
+        generation = self.cache.generation
+        with self.assertRaises(RuntimeError):
+            async with Orm.transaction():
+                await self.rename('rolled back')
+                raise RuntimeError('abort')
+        self.assertEqual(self.cache.generation, generation)
+        found = await outside_transaction(Customer.find(self.customer.id))
+        self.assertEqual(found.name, 'old')
+
+
+if __name__ == '__main__':
+    unittest.main()